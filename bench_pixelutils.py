@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Benchmark the pixelutils kernels.
+
+Usage
+    bench_pixelutils.py [<width> <height>]
+
+First print the time per pixel (in ns) of each stage of the decoding pipeline:
+decode_pixel_deltas, compute_pixel_values, demosaic and histogram_equalize, so
+that regressions can be attributed to a specific kernel. Compare builds by
+running this against each of them (see setup.py).
+
+Then, for each post-decoding kernel, print the throughput (in Mpixel/s) of the
+float32 and float64 versions and the maximum deviation of the float32 output
+from the float64 one (relative to the 65535 full scale).
+
+Inputs are synthetic 12 bit images of the given size (default 4288x2848, i.e. a
+D300 frame), always the same ones.
+"""
+import sys
+import time
+
+import numpy
+
+import pixelutils
+from huffman_tables import huff as NIKON_TREE
+
+
+
+# Constants
+WIDTH = 4288
+HEIGHT = 2848
+REPEAT = 3
+DTYPES = (numpy.double, numpy.float32)
+CFA_PATTERN = (2, 1, 1, 0)
+TREE_INDEX = 0
+DELTA_SIGMA = 20
+
+
+
+
+def huffman_codes(tree_index):
+    """
+    Return (codes, code_lens): the code of each delta bit length in the tree
+    NIKON_TREE[tree_index] and its length in bits. Lengths that the tree only
+    stores lossily have a code length of 0.
+    """
+    num_bits, tree = NIKON_TREE[tree_index]
+    codes = numpy.zeros(shape=(32, ), dtype=numpy.int64)
+    code_lens = numpy.zeros(shape=(32, ), dtype=numpy.int64)
+    for i, (used, length, shift, delta_len) in enumerate(tree):
+        if(shift == 0 and not code_lens[length]):
+            codes[length] = i >> (num_bits - used)
+            code_lens[length] = used
+    return(codes, code_lens)
+
+
+def encode_deltas(deltas, tree_index=TREE_INDEX, split_row=-1):
+    """
+    Huffman encode the (h, w) int `deltas` the way NEFs do (see
+    pixelutils.decode_pixel_deltas): rows [0, split_row) with the tree
+    NIKON_TREE[tree_index] and, if split_row > 0, the other rows with the next
+    tree. Return the encoded bytes as a uint8 array.
+
+    Raise ValueError if a delta is too large to be encoded exactly by its tree.
+    """
+    deltas = numpy.asarray(deltas, dtype=numpy.int64)
+    rows = numpy.repeat(numpy.arange(deltas.shape[0]), deltas.shape[1])
+    deltas = deltas.ravel()
+
+    # Each delta is its length code followed by its length bits, negative
+    # values being stored as d + 2**length - 1.
+    lengths = numpy.frexp(numpy.abs(deltas))[1].astype(numpy.int64)
+    (codes, code_lens) = huffman_codes(tree_index)
+    codes = codes[lengths]
+    code_lens = code_lens[lengths]
+    if(split_row > 0):
+        (split_codes, split_code_lens) = huffman_codes(tree_index + 1)
+        after = rows >= split_row
+        codes[after] = split_codes[lengths[after]]
+        code_lens[after] = split_code_lens[lengths[after]]
+    if(not code_lens.all()):
+        raise(ValueError('Some deltas cannot be encoded exactly.'))
+    values = numpy.where(deltas < 0, deltas + (1 << lengths) - 1, deltas)
+    words = (codes << lengths) | values
+    word_lens = code_lens + lengths
+
+    # Lay the words out bit by bit, most significant bit first.
+    ends = numpy.cumsum(word_lens)
+    bits = numpy.zeros(shape=(ends[-1] + 64, ), dtype=numpy.uint8)
+    for k in range(word_lens.max()):
+        mask = word_lens > k
+        bits[ends[mask] - 1 - k] = (words[mask] >> k) & 1
+    return(numpy.packbits(bits))
+
+
+def time_kernel(name, num_pixels, fun, make_args):
+    """
+    Time `fun`, calling make_args() to get fresh input arguments for each call,
+    and print its best time per pixel.
+    """
+    best = None
+    for i in range(REPEAT):
+        args = make_args()
+        t0 = time.time()
+        fun(*args)
+        dt = time.time() - t0
+        if(best is None or dt < best):
+            best = dt
+    print('%-22s  %8.2f' % (name, best / num_pixels * 1e9))
+
+
+def run(name, num_pixels, fun, make_args):
+    """
+    Time `fun` for each of DTYPES, calling make_args(dtype) to get fresh input
+    arguments for each call, and print the results.
+    """
+    outputs = {}
+    rates = {}
+    for dtype in DTYPES:
+        best = None
+        for i in range(REPEAT):
+            args = make_args(dtype)
+            t0 = time.time()
+            out = fun(*args)
+            dt = time.time() - t0
+            if(best is None or dt < best):
+                best = dt
+        outputs[dtype] = numpy.asarray(out, dtype=numpy.double)
+        rates[dtype] = num_pixels / best / 1e6
+    dev = numpy.abs(outputs[numpy.float32] - outputs[numpy.double]).max()
+    print('%-20s  %8.1f  %8.1f  %5.2fx  %.3g' % (name,
+                                                 rates[numpy.double],
+                                                 rates[numpy.float32],
+                                                 rates[numpy.float32] /
+                                                 rates[numpy.double],
+                                                 dev / 65535.))
+
+
+
+
+if(__name__ == '__main__'):
+    width = WIDTH
+    height = HEIGHT
+    if(len(sys.argv) == 3):
+        width = int(sys.argv[1])
+        height = int(sys.argv[2])
+    num_pixels = width * height
+
+    # Random deltas, Huffman encoded, for the decoder.
+    numpy.random.seed(42)
+    deltas = numpy.random.normal(0, DELTA_SIGMA, size=(height, width))
+    deltas = deltas.round().astype(numpy.int32)
+    byte_buffer = encode_deltas(deltas)
+    vert_preds = [[2048, 2048], [2048, 2048]]
+    curve = list(range(1 << 12))
+
+    # A smooth-ish 12 bit mosaic: a gradient plus some noise.
+    mosaic = (numpy.linspace(0, 3000, width)[numpy.newaxis, :] +
+              numpy.linspace(0, 1000, height)[:, numpy.newaxis] +
+              numpy.random.normal(0, 20, size=(height, width)))
+    mosaic = numpy.clip(mosaic, 0, 4095).astype(numpy.uint16)
+    planes = {}
+    for dtype in DTYPES:
+        planes[dtype] = pixelutils.interpolate_mosaic(mosaic, CFA_PATTERN, dtype)
+    scaled = {}
+    for dtype in DTYPES:
+        scaled[dtype] = pixelutils.balance_channels(planes[dtype].copy())
+
+    print('%d x %d pixels' % (width, height))
+    print('%-22s  %8s' % ('kernel', 'ns/pixel'))
+    time_kernel('decode_pixel_deltas', num_pixels,
+                pixelutils.decode_pixel_deltas,
+                lambda: (width, height, TREE_INDEX, byte_buffer, -1,
+                         NIKON_TREE))
+    time_kernel('compute_pixel_values', num_pixels,
+                pixelutils.compute_pixel_values,
+                lambda: (deltas, [0, 0], vert_preds, curve, numpy.uint16))
+    time_kernel('demosaic', num_pixels,
+                pixelutils.demosaic,
+                lambda: (mosaic, CFA_PATTERN))
+    time_kernel('histogram_equalize', num_pixels,
+                pixelutils.histogram_equalize,
+                lambda: (scaled[numpy.double].copy(), ))
+    print('')
+
+    print('%-20s  %8s  %8s  %6s  %s' % ('kernel', 'f64 Mp/s', 'f32 Mp/s',
+                                        'gain', 'max deviation'))
+    run('interpolate_mosaic', num_pixels,
+        pixelutils.interpolate_mosaic,
+        lambda dtype: (mosaic, CFA_PATTERN, dtype))
+    run('balance_channels', num_pixels,
+        pixelutils.balance_channels,
+        lambda dtype: (planes[dtype].copy(), True, False, (2., 1., 1.5)))
+    run('histogram_equalize', num_pixels,
+        pixelutils.histogram_equalize,
+        lambda dtype: (scaled[dtype].copy(), ))
+    run('demosaic', num_pixels,
+        pixelutils.demosaic,
+        lambda dtype: (mosaic, CFA_PATTERN, True, True, (2., 1., 1.5), None,
+                       dtype))
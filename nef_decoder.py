@@ -20,10 +20,15 @@ Options
 Example
     nef_decoder.py -o bar.jpg foo.nef
 """
+import mmap
 import os
 import struct
+import sys
+import tempfile
 
 import pixelutils
+import prefetch
+import rawarchive
 
 import numpy
 
@@ -257,9 +262,47 @@ TYPES = {1:   ('B',         1),
 
 DEF_TYPE =    ('B',    1)
 CHILD_IFD_TAGS = (330, 34665)
+EXIF_IFD_TAG_ID = 34665
+
+# Type ID -> size in bytes, as an array. Unknown type IDs use the last entry.
+TYPE_SIZES = numpy.array([TYPES.get(i, DEF_TYPE)[1]
+                          for i in range(max(TYPES) + 2)])
+
+# IFD entries, as stored in the file (see decode_ifd).
+IFD_ENTRY_DTYPE = numpy.dtype([('tag_id', '>u2'),
+                               ('typ_id', '>u2'),
+                               ('len',    '>u4'),
+                               ('value',  '>u4')])
+
+# Out-of-line tag values closer than this many bytes are read in one go.
+MAX_READ_GAP = 4096
+
+# IFD roles (see IFD).
+RAW_ROLE = 'raw'
+PREVIEW_ROLE = 'preview'
+EXIF_ROLE = 'exif'
+MAKERNOTE_ROLE = 'makernote'
+
+# Percentiles of the raw values used as black and white level estimates.
+BLACK_PERCENTILE = 0.01
+WHITE_PERCENTILE = 99.99
+COLOR_NAMES = 'RGB'
+
+# Tags copied to raw archives (see NEFFile.export): camera, date and exposure
+# from the IFDs and ISO and white balance from the Makernote.
+ARCHIVE_TAG_IDS = (271, 272, 274, 306, 33434, 33437, 36867, 37386)
+ARCHIVE_MAKERNOTE_TAG_IDS = (2, 12)
 
 VERBOSE_TAG_FMT = '0x%04x  %s  %s  %02d  %s'
 
+# Types of the demosaiced images (see check_dtype).
+IMAGE_DTYPES = (numpy.dtype(numpy.float32), numpy.dtype(numpy.double))
+
+# Bytes per pixel of the intermediate arrays of decode_mosaic: int32 deltas and
+# the uint16 mosaic.
+DECODE_BYTES_PER_PIXEL = 4 + 2
+MIN_BAND_ROWS = 16
+
 
 
 
@@ -301,7 +344,9 @@ def get_raw_image_info(ifds,
             info['img_bpstrip'] = ifd[img_bpstrip_tag_id][-1]
             info['img_planar_config'] = ifd[img_planar_config_tag_id][-1]
             info['img_cfa_repeat_size'] = ifd[img_cfa_repeat_size_tag_id][-1]
-            info['img_cfa_pattern'] = ifd[img_cfa_pattern_tag_id][-1]
+            # The CFA pattern: one color code (0=R, 1=G, 2=B) per pixel of the
+            # repeat pattern, row by row.
+            info['img_cfa_pattern'] = tuple(ifd[img_cfa_pattern_tag_id][-1])
             info['img_sensing'] = ifd[img_sensing_tag_id][-1]
     if(not info):
         raise(Exception('Unable to find raw image info.'))
@@ -312,14 +357,70 @@ def get_raw_image_info(ifds,
 
 
 
-def get_tag_value(ifds, tag_id, tag_name=None):
+class IFD(dict):
+    """
+    A decoded IFD. This is a dictionary of the form
+        {tag_id: [val_abs_offset, tag, typ_fmt, len, val]}
+    which also knows its `role` in the file (one of RAW_ROLE, PREVIEW_ROLE,
+    EXIF_ROLE, MAKERNOTE_ROLE or None) and its absolute offset `abs_offset`.
+    """
+    def __init__(self, role=None, abs_offset=0):
+        dict.__init__(self)
+        self.role = role
+        self.abs_offset = abs_offset
+
+
+def index_ifds(ifds):
+    """
+    Build a tag index for the list of IFDs `ifds`: a dictionary of the form
+        {tag_id: [val_abs_offset, tag, typ_fmt, len, val],
+         (role, tag_id): [val_abs_offset, tag, typ_fmt, len, val]}
+    where, as in get_tag_value, later IFDs win over earlier ones if a tag is
+    present in more than one of them. The index can be passed to get_tag_value
+    (and anything expecting a single IFD) for O(1) lookups.
+    """
+    index = {}
+    for ifd in ifds:
+        role = getattr(ifd, 'role', None)
+        for tag_id, entry in ifd.items():
+            index[tag_id] = entry
+            if(role is not None):
+                index[(role, tag_id)] = entry
+    return(index)
+
+
+class IFDList(list):
+    """
+    The IFDs of a file, as returned by decode_tags: a list of IFD instances
+    which also carries their tag index `tags` (see index_ifds). decode_tags
+    adds the Makernote tags to it, under MAKERNOTE_ROLE only (their IDs clash
+    with EXIF ones). get_tag_value uses the index, so lookups do not scan every
+    IFD. The index is built once: it does not follow changes to the list.
+    """
+    def __init__(self, ifds=(), tags=None):
+        list.__init__(self, ifds)
+        if(tags is None):
+            tags = index_ifds(self)
+        self.tags = tags
+
+
+def get_tag_value(ifds, tag_id, tag_name=None, role=None):
     """
     Given a list of IFDs, a IFD tag ID and optionally its corresponding tag name
     (as an extra check), return the tag value. Raise an exception if the tag is
     not found. This assumes that tag values CANNOT be None.
+
+    `ifds` can also be a single IFD, the output of index_ifds or an IFDList
+    (whose index is then used), in which case the lookup is a simple
+    dictionary access. With an index, `role` restricts the search to the IFDs
+    with that role.
     """
+    if(role is not None):
+        tag_id = (role, tag_id)
+    if(isinstance(ifds, IFDList)):
+        ifds = ifds.tags
     if(isinstance(ifds, dict)):
-        # We just have a single IFD! Create a temp list with just this element.
+        # We just have a single IFD or an index.
         ifds = [ifds, ]
 
     # FIXME: use a random number/string instead of None.
@@ -327,16 +428,16 @@ def get_tag_value(ifds, tag_id, tag_name=None):
     for ifd in ifds:
         # Each IFD is a dictionary of the form:
         #  {tag_id: [val_abs_offset, tag, typ_fmt, len, val]}
-        if(not ifd.has_key(tag_id) or
+        if(tag_id not in ifd or
            (tag_name != None and ifd[tag_id][1] != tag_name)):
             continue
 
         val = ifd[tag_id][-1]
     if(val == None and tag_name == None):
-        raise(Exception('Tag ID %d not found.' % (tag_id)))
+        raise(Exception('Tag ID %s not found.' % (str(tag_id))))
     elif(val == None):
-        raise(Exception('Tag ID %d/Tag Name %s not found.' \
-                        % (tag_id, tag_name)))
+        raise(Exception('Tag ID %s/Tag Name %s not found.' \
+                        % (str(tag_id), tag_name)))
     # Else: just return the value.
     return(val)
 
@@ -345,7 +446,9 @@ def unpack(fmt, buffer, big_endian=True):
     """
     Simple wrapper around struct.unpack(). The input `fmt` and `buffer` have the
     same meaning that in the struct.unpack case, with a few exceptions:
-        fmt = '_str':       do not unpack `buffer` and just return it as string.
+        fmt = '_str':       do not unpack `buffer` and just return it as string
+                            (decoded as latin-1 on Python 3), without its
+                            trailing NULs.
         fmt = '_rational'   unpack `buffer` as 2 4-byte integer (a / b).
     """
     if(big_endian):
@@ -354,7 +457,10 @@ def unpack(fmt, buffer, big_endian=True):
         prefix = '<'
 
     if(not fmt or fmt == '_str'):
-        return(str(buffer))
+        text = bytes(buffer).rstrip(b'\0')
+        if(not isinstance(text, str)):
+            text = text.decode('latin-1')
+        return(text)
     elif((fmt == '_urational' or fmt == '_rational') and len(buffer) % 8 == 0):
         if(fmt == '_urational'):
             fmt = prefix + 'L'
@@ -386,8 +492,173 @@ def unpack(fmt, buffer, big_endian=True):
     raise(NotImplementedError('Unsupported format/data type'))
 
 
-def decode_pixel_data(data, raw_info, makernote_ifd, makernote_abs_offset,
-                      wb_mult=(1., 1., 1.), verbose=False):
+def get_roi_bounds(roi, width, height, halo=1):
+    """
+    Given a region of interest `roi` = (x, y, w, h) inside an image of size
+    `width` x `height`, return the bounds (x0, y0, x1, y1) of the region that
+    has to be decoded: the ROI plus a `halo` pixel border (where available),
+    expanded so that x0 and y0 are even (to preserve the CFA pattern phase) and
+    so that the region has an even size.
+    """
+    (x, y, w, h) = roi
+    if(w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > width or y + h > height):
+        raise(Exception('ROI %s is outside of the %dx%d image.' \
+                        % (str(roi), width, height)))
+
+    x0 = max(0, x - halo) & ~1
+    y0 = max(0, y - halo) & ~1
+    x1 = min(width, x + w + halo)
+    y1 = min(height, y + h + halo)
+    x1 = min(width, x1 + (x1 - x0) % 2)
+    y1 = min(height, y1 + (y1 - y0) % 2)
+    return(x0, y0, x1, y1)
+
+
+def check_dtype(dtype):
+    """
+    Return `dtype` as a numpy.dtype if it is one of the types the demosaiced
+    images can have (numpy.float32 or numpy.double), raise ValueError otherwise.
+    """
+    try:
+        checked = numpy.dtype(dtype)
+    except TypeError:
+        checked = numpy.dtype(numpy.void)
+    if(checked not in IMAGE_DTYPES):
+        raise(ValueError('Unsupported image type %s: use numpy.float32 or '
+                         'numpy.double.' % (str(dtype))))
+    return(checked)
+
+
+def spill_array(shape, dtype):
+    """
+    Return a zeroed array of the given `shape` and `dtype`, backed by an
+    anonymous temporary file (in tempfile.gettempdir()) rather than by memory:
+    the file goes away with the array.
+    """
+    f = tempfile.TemporaryFile()
+    try:
+        return(numpy.memmap(f, dtype=dtype, mode='w+', shape=shape))
+    finally:
+        f.close()
+
+
+def get_memory_estimate(raw_info, dtype=numpy.double):
+    """
+    Estimate the peak memory (in bytes) needed to decode and demosaic the raw
+    image (see get_raw_image_info) in memory, with output type `dtype`.
+    """
+    num_pixels = raw_info['img_width'] * raw_info['img_height']
+    itemsize = numpy.dtype(dtype).itemsize
+    return(num_pixels * max(DECODE_BYTES_PER_PIXEL, 2 + 3 * itemsize))
+
+
+def get_band_rows(width, max_memory, dtype=numpy.double):
+    """
+    Number of rows (even) of the bands that demosaic_bands processes to stay
+    within `max_memory` bytes for an image `width` pixels wide.
+    """
+    band_bytes = 3 * width * numpy.dtype(dtype).itemsize
+    rows = max(MIN_BAND_ROWS, max_memory // (4 * band_bytes))
+    return(int(rows) & ~1)
+
+
+def demosaic_bands(mosaic, cfa_pattern=(2, 1, 1, 0), scale=True,
+                   equalize=False, wb_mult=(1., 1., 1.), dtype=numpy.double,
+                   band_rows=MIN_BAND_ROWS):
+    """
+    Same as pixelutils.demosaic, but `band_rows` rows at a time and with the
+    output in a temporary file (see spill_array): return the (3, h, w) result
+    as a numpy.memmap. The result is identical to that of pixelutils.demosaic.
+
+    Each band is interpolated with a one row border (see get_roi_bounds), so
+    that its rows come out the same as in the whole image, and written to the
+    file. Then the image is white balanced and scaled (and equalized), again
+    band by band. The file is mapped again for each band: only the band being
+    processed needs to be in memory.
+    """
+    (height, width) = mosaic.shape
+    band_rows = max(2, band_rows & ~1)
+    bands = [(y0, min(height, y0 + band_rows))
+             for y0 in range(0, height, band_rows)]
+    f = tempfile.TemporaryFile()
+    shape = (3, height, width)
+    numpy.memmap(f, dtype=dtype, mode='w+', shape=shape).flush()
+
+    # Interpolate each band and find the channel maxima.
+    maxima = numpy.empty(shape=(3, ), dtype=numpy.double)
+    maxima.fill(-numpy.inf)
+    for (y0, y1) in bands:
+        (x0, a, x1, b) = get_roi_bounds((0, y0, width, y1 - y0), width, height)
+        planes = pixelutils.interpolate_mosaic(mosaic[a:b], cfa_pattern, dtype)
+        planes = planes[:, y0 - a:y1 - a]
+        maxima = numpy.maximum(maxima, pixelutils.channel_maxima(planes))
+        pixels = numpy.memmap(f, dtype=dtype, mode='r+', shape=shape)
+        pixels[:, y0:y1] = planes
+        pixels.flush()
+        del(pixels, planes)
+
+    # White balance and scale, then equalize. See pixelutils.balance_channels.
+    factor = 1.
+    if(scale):
+        factor = pixelutils.scale_factor(maxima, wb_mult)
+    hists = None
+    if(equalize):
+        hists = numpy.zeros(shape=(3, 65536), dtype=numpy.int64)
+    passes = []
+    if(scale or hists is not None or wb_mult != (1., 1., 1.)):
+        passes.append(lambda band: pixelutils.scale_channels(band, factor,
+                                                             hists, wb_mult))
+    if(equalize):
+        passes.append(lambda band: pixelutils.histogram_equalize(band, hists))
+    for process in passes:
+        for (y0, y1) in bands:
+            pixels = numpy.memmap(f, dtype=dtype, mode='r+', shape=shape)
+            process(pixels[:, y0:y1])
+            pixels.flush()
+            del(pixels)
+
+    pixels = numpy.memmap(f, dtype=dtype, mode='r+', shape=shape)
+    f.close()
+    return(pixels)
+
+
+def get_peak_rss():
+    """
+    Return the peak resident set size of the process in bytes (see
+    reset_peak_rss).
+    """
+    try:
+        for line in open('/proc/self/status'):
+            if(line.startswith('VmHWM:')):
+                return(int(line.split()[1]) * 1024)
+    except (IOError, OSError):
+        pass
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if(sys.platform == 'darwin'):
+        return(peak)
+    return(peak * 1024)
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process to its current value, so
+    that get_peak_rss measures what comes next. Only possible on Linux: return
+    False if it could not be done (get_peak_rss is then the peak since the
+    process started).
+    """
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        f.write('5')
+        f.close()
+    except (IOError, OSError):
+        return(False)
+    return(True)
+
+
+def get_linearization(data, raw_info, makernote_ifd):
     """
     The linearization table is stored inside the Nikon Marker Note and is >1000
     bytes in length.
@@ -403,6 +674,10 @@ def decode_pixel_data(data, raw_info, makernote_ifd, makernote_abs_offset,
         data.seek(start+562, os.SEEK_SET)
         1   short   split value)
 
+    Return a dictionary with the Huffman tree index (`tree_index`), the
+    `split_row` (-1 if none), the initial predictors (`vert_preds` and
+    `horiz_preds`), the linearization `curve` and the number of its distinct
+    values (`curve_max_len`).
     """
     # Get the NEF compression flag.
     compression = makernote_ifd[NEF_COMPRESSION_TAG_ID][-1]
@@ -446,33 +721,32 @@ def decode_pixel_data(data, raw_info, makernote_ifd, makernote_abs_offset,
 
     max = 1 << image_bps & 0x7fff
     num_points = unpack('H', data.read(2))[0]
+    step = 0
     if(num_points > 1):
-        step = int(float(max) / (num_points - 1))
+        step = max // (num_points - 1)
     values = unpack('H'*num_points, data.read(num_points * 2))
 
     # Decode the curve.
     curve = None
     split_row = -1
     if(v0 == 0x44 and v1 == 0x20 and step > 0):
-        curve_max_len = 1 << tiff_bps & 0x7fff
+        curve_max_len = max
 
         # The curve has length `curve_max_len` but we only have a `num_points`
-        # points, so we need to interpolate.
-        step = int(float(curve_max_len) / float(curve_size - 1))
-        curve = [0, ] * curve_max_len
-        for i in xrange(num_points):
-            curve[i*step] = values[i]
+        # points, one every `step`, so we need to interpolate.
+        points = numpy.zeros(shape=(curve_max_len + step, ), dtype=numpy.int64)
+        points[0:num_points*step:step] = values
 
         # Now interpolate between those values.
-        step = float(step)
-        for i in xrange(curve_max_len):
-            curve[i] = int(float(curve[i-i%step] * (step-i%step) +
-                                 curve[i-i%step+step] * (i%step)) / step)
+        i = numpy.arange(curve_max_len)
+        i_prev = i - i % step
+        curve = (points[i_prev] * (step - i % step) +
+                 points[i_prev + step] * (i % step)) // step
 
         # Finally, get the 'split value'. This is the row where we need to
         # re-init the Huffman tree.
         data.seek(abs_offset + 562, os.SEEK_SET)
-        split_row = unpack('H', data.read(2))
+        split_row = unpack('H', data.read(2))[0]
     elif(v0 != 0x46 and num_points <= 16385):
         # Simple case: curve = values. Also, no split row here.
         curve = values
@@ -485,53 +759,299 @@ def decode_pixel_data(data, raw_info, makernote_ifd, makernote_abs_offset,
     while(curve[curve_max_len-2] == curve[curve_max_len-1]):
         curve_max_len -= 1
 
-    # Now decode the pixel values. This is a bit of a mess, but not too bad.
-    pixel_abs_offset = raw_info['img_offset']
-    data.seek(pixel_abs_offset, os.SEEK_SET)
+    return({'tree_index': tree_index,
+            'split_row': split_row,
+            'vert_preds': vert_preds,
+            'horiz_preds': horiz_preds,
+            'curve': curve,
+            'curve_max_len': curve_max_len})
 
+
+def read_buffer(data, offset):
+    """
+    Return the content of `data` (a file or a mmap) from `offset` to the end as
+    a uint8 array. Nothing is copied if `data` is a mmap.
+    """
+    if(isinstance(data, mmap.mmap)):
+        return(numpy.frombuffer(data, dtype=numpy.uint8)[offset:])
+    data.seek(offset, os.SEEK_SET)
+    return(numpy.fromfile(data, dtype=numpy.uint8))
+
+
+def decode_mosaic(data, raw_info, linearization, roi=None, hists=None,
+                  spill=False):
+    """
+    Decode the raw pixel data of `data` (see get_raw_image_info and
+    get_linearization) and return the linearized CFA mosaic: a (h, w) uint16
+    array.
+
+    If `roi` = (x, y, w, h) is given, only decode what is needed for the region
+    get_roi_bounds(roi, ...) of the image and return that instead.
+
+    If `hists` is given, the raw code histograms of the returned pixels are
+    added to it (see pixelutils.compute_pixel_values and get_raw_stats).
+
+    If `spill` is True, the deltas and the mosaic are kept in temporary files
+    rather than in memory (see spill_array) and the mosaic is a numpy.memmap.
+    """
     # Get the image size.
     width = raw_info['img_width']
     height = raw_info['img_height']
 
-    # Cast data into a string of bits of length width * height * 8
-    byte_buffer = numpy.fromfile(data, dtype=numpy.uint8)
-    bit_buffer = numpy.ascontiguousarray(numpy.unpackbits(byte_buffer),
-                                         dtype=numpy.uint8)
+    # Read the Huffman encoded data: decode_pixel_deltas works on the bytes.
+    byte_buffer = read_buffer(data, raw_info['img_offset'])
+
+    # Do we only need a part of the image? compute_pixel_values never fills the
+    # last column of what it gets, so we decode one more column pair than the
+    # region, unless we are at the right edge already.
+    region = None
+    left = 0
+    hist_cols = None
+    if(roi is not None):
+        (x0, y0, x1, y1) = get_roi_bounds(roi, width, height)
+        region = (x0, y0, min(width, x1 + 2), y1)
+        if(x0 >= 2):
+            left = 2
+        # Only count the columns that we return.
+        hist_cols = (left, left + x1 - x0)
+
+    # Where do the deltas and the pixel values go?
+    deltas = None
+    pixels = None
+    if(spill and region is None):
+        deltas = spill_array((height, width), numpy.int32)
+        pixels = spill_array((height, width), numpy.uint16)
 
     # Decode the actual pixel differences/deltas.
     deltas = pixelutils.decode_pixel_deltas(width,
                                             height,
-                                            tree_index,
-                                            bit_buffer,
-                                            split_row,
-                                            NIKON_TREE)
+                                            linearization['tree_index'],
+                                            byte_buffer,
+                                            linearization['split_row'],
+                                            NIKON_TREE,
+                                            region,
+                                            deltas)
+    del(byte_buffer)
 
     # Now turn all those deltas in pixel values. The only raw pixel value is
     # the one at top, left for each color. Differences are done color by color.
-    # pixels = compute_pixel_values(deltas, horiz_preds, vert_preds, curve)
     pixels = pixelutils.compute_pixel_values(deltas,
-                                             horiz_preds,
-                                             vert_preds,
-                                             curve)
+                                             linearization['horiz_preds'],
+                                             linearization['vert_preds'],
+                                             linearization['curve'],
+                                             numpy.uint16,
+                                             hists,
+                                             pixels,
+                                             hist_cols)
+    del(deltas)
+    if(roi is None):
+        return(pixels)
+
+    # Drop the columns we only needed for the predictors.
+    return(numpy.ascontiguousarray(pixels[:, left:left + x1 - x0]))
+
+
+def get_raw_stats(hists, linearization, cfa_pattern):
+    """
+    Turn the (4, pixelutils.NUM_CODES) raw code histograms `hists` of the CFA
+    positions (see decode_mosaic) into exposure statistics. Return a dictionary
+    with
+        hists       the histograms themselves
+        colors      the color of each CFA position (0=R, 1=G, 2=B)
+        count       the number of pixels of each CFA position
+        min, max    the smallest and largest linearized value
+        clipped     the number of pixels at or above the saturation code
+        black       the BLACK_PERCENTILE percentile of the linearized values
+        white       the WHITE_PERCENTILE percentile of the linearized values
+        saturation  the linearized value of the saturation code
+    All but the last one are per CFA position arrays (in row major order).
+    Values of empty positions are 0.
+    """
+    curve = numpy.asarray(linearization['curve'], dtype=numpy.int64)
+    num_codes = min(hists.shape[1], curve.size)
+    saturation = min(linearization['curve_max_len'], num_codes) - 1
+
+    stats = {'hists': hists,
+             'colors': numpy.array(cfa_pattern),
+             'count': hists.sum(axis=1),
+             'clipped': hists[:, saturation:].sum(axis=1),
+             'saturation': int(curve[saturation])}
+    for key in ('min', 'max', 'black', 'white'):
+        stats[key] = numpy.zeros(shape=(4, ), dtype=numpy.int64)
+
+    for k in range(4):
+        hist = hists[k, :num_codes]
+        codes = numpy.flatnonzero(hist)
+        if(not codes.size):
+            continue
+        cdf = numpy.cumsum(hist)
+        total = cdf[-1]
+        stats['min'][k] = curve[codes[0]]
+        stats['max'][k] = curve[codes[-1]]
+        stats['black'][k] = curve[numpy.searchsorted(
+            cdf, total * BLACK_PERCENTILE / 100.)]
+        stats['white'][k] = curve[numpy.searchsorted(
+            cdf, total * WHITE_PERCENTILE / 100.)]
+    return(stats)
+
+
+def get_cfa_pattern(raw_info):
+    """
+    Return the CFA pattern of the raw image (see get_raw_image_info). Raise an
+    exception if it is not one of the 2x2 Bayer patterns that we support.
+    """
+    cfa_pattern = raw_info['img_cfa_pattern']
+    if(tuple(raw_info['img_cfa_repeat_size']) != (2, 2) or
+       cfa_pattern not in pixelutils.CFA_PHASES):
+        raise(NotImplementedError('Unsupported CFA pattern %s.' \
+                                  % (str(cfa_pattern))))
+    return(cfa_pattern)
 
-    # Now demosaic the Bayer pattern.
-    demosaiced = pixelutils.demosaic(pixels, True, False, wb_mult)
-    return(demosaiced)
 
+def decode_pixel_data(data, raw_info, makernote_ifd, makernote_abs_offset,
+                      wb_mult=(1., 1., 1.), roi=None, dtype=numpy.double,
+                      verbose=False, stats=None, demosaic=True,
+                      max_memory=None):
+    """
+    Decode the raw image (see get_linearization and decode_mosaic) and
+    demosaic it. Return a (3, h, w) array of type `dtype` (numpy.float32 or
+    numpy.double, see check_dtype).
+
+    If `roi` = (x, y, w, h) is given, only decode what is needed to produce that
+    region of the image (plus a small border for demosaicing) and return an
+    array of shape (3, h, w). The region is interpolated exactly as in the
+    whole image, but then scaled to its own maximum: it only depends on the
+    pixels inside it and differs from the same crop of the whole image by a
+    constant factor.
+
+    If `stats` is a dictionary, fill it with the raw statistics of the decoded
+    pixels (see get_raw_stats). These are gathered while decoding, at almost no
+    extra cost. With a `roi`, they cover the region and its border, i.e. the
+    area get_roi_bounds returns (the mosaic returned when `demosaic` is False).
+
+    If `demosaic` is False, stop after decoding and return the uint16 CFA
+    mosaic instead (see decode_mosaic): e.g. to only compute `stats`.
+
+    If decoding the whole image would take more than `max_memory` bytes (see
+    get_memory_estimate), the intermediate arrays and the result go to
+    temporary files instead (see decode_mosaic and demosaic_bands) and the
+    returned array is a numpy.memmap. The values are the same either way.
+    `max_memory` does not apply to regions of interest.
+    """
+    dtype = check_dtype(dtype)
+    cfa_pattern = get_cfa_pattern(raw_info)
+    linearization = get_linearization(data, raw_info, makernote_ifd)
+    spill = (roi is None and max_memory is not None and
+             get_memory_estimate(raw_info, dtype) > max_memory)
+    if(verbose and spill):
+        print('Decoding out of core (estimate: %d bytes, budget: %d bytes).' \
+              % (get_memory_estimate(raw_info, dtype), max_memory))
+    hists = None
+    if(stats is not None):
+        hists = numpy.zeros(shape=(4, pixelutils.NUM_CODES), dtype=numpy.int64)
+    pixels = decode_mosaic(data, raw_info, linearization, roi, hists, spill)
+    if(stats is not None):
+        stats.update(get_raw_stats(hists, linearization, cfa_pattern))
+    if(not demosaic):
+        return(pixels)
+    if(spill):
+        band_rows = get_band_rows(raw_info['img_width'], max_memory, dtype)
+        return(demosaic_bands(pixels, cfa_pattern, True, False, wb_mult, dtype,
+                              band_rows))
 
-def decode_file(file_name, wb_mult=(1., 1., 1.), verbose=False):
+    # Now demosaic the Bayer pattern.
+    if(roi is None):
+        demosaiced = pixelutils.demosaic(pixels, cfa_pattern, True, False,
+                                         wb_mult, dtype=dtype)
+        return(demosaiced)
+
+    # Interpolate the ROI and its border, crop the border away and only then
+    # white balance and scale, so that the border does not count. The decoded
+    # area starts on even rows and columns, so the CFA pattern is the same as
+    # for the whole image.
+    (x, y, w, h) = roi
+    (x0, y0, x1, y1) = get_roi_bounds(roi,
+                                      raw_info['img_width'],
+                                      raw_info['img_height'])
+    planes = pixelutils.interpolate_mosaic(pixels, cfa_pattern, dtype)
+    planes = numpy.ascontiguousarray(planes[:, y-y0:y-y0+h, x-x0:x-x0+w])
+    return(pixelutils.balance_channels(planes, True, False, wb_mult))
+
+
+def decode_file(file_name, wb_mult=(1., 1., 1.), verbose=False, roi=None,
+                dtype=numpy.double, stats=None, demosaic=True, max_memory=None):
     """
     Read `file_name` and pass its content to `decode_nef`. Return the decoded
     image data.
+
+    If `roi` = (x, y, w, h) is given, only that region of the image is decoded
+    (see `decode_pixel_data`). `dtype` is the type of the decoded image:
+    numpy.float32 halves the memory footprint of numpy.double. See
+    decode_pixel_data for `stats`, `demosaic` and `max_memory`. With a
+    `max_memory`, the file is memory mapped rather than read.
     """
+    dtype = check_dtype(dtype)
+
     # Read the NEF data.
     f = open(file_name, 'rb')
-    output = decode_nef(f, wb_mult, verbose)
+    if(max_memory is not None):
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        f = data
+    output = decode_nef(f, wb_mult, verbose, roi=roi, dtype=dtype, stats=stats,
+                        demosaic=demosaic, max_memory=max_memory)
     f.close()
     return(output)
 
 
-def decode_nef(data, wb_mult=(1., 1., 1.), verbose=False):
+def decode_files(file_names, wb_mult=(1., 1., 1.), verbose=False, roi=None,
+                 dtype=numpy.double, stats=False, demosaic=True,
+                 depth=prefetch.DEPTH, use_mmap=False, max_memory=None):
+    """
+    Decode each of `file_names` in turn (see decode_nef) and yield
+        (file_name, output, stats, error)
+    where `output` is what decode_nef returns and `stats` the raw statistics
+    of the file (see get_raw_stats) if `stats` is True, None otherwise. If the
+    file could not be read or decoded, `output` and `stats` are None and
+    `error` is the exception that was raised.
+
+    While a file is being decoded, up to `depth` of the next ones are read on a
+    background thread (see prefetch.Prefetcher). With `depth` = 0 files are
+    read one at a time, when needed. See decode_pixel_data for `max_memory`.
+    With a `max_memory`, files are always memory mapped (`use_mmap`) rather
+    than copied in memory, which the budget would not account for.
+    """
+    dtype = check_dtype(dtype)
+    if(max_memory is not None):
+        use_mmap = True
+    if(depth > 0):
+        reader = prefetch.Prefetcher(file_names, depth, use_mmap)
+    else:
+        reader = prefetch.read_files(file_names, use_mmap)
+
+    try:
+        for (file_name, data, error) in reader:
+            output = None
+            file_stats = None
+            if(error is None):
+                if(stats):
+                    file_stats = {}
+                try:
+                    output = decode_nef(data, wb_mult, verbose, roi=roi,
+                                        dtype=dtype, stats=file_stats,
+                                        demosaic=demosaic,
+                                        max_memory=max_memory)
+                except Exception as e:
+                    error = e
+                    file_stats = None
+                data.close()
+            yield(file_name, output, file_stats, error)
+    finally:
+        if(depth > 0):
+            reader.close()
+
+
+def decode_tags(data, verbose=False):
     """
     The NEF header is a TIFF header:
 
@@ -539,10 +1059,14 @@ def decode_nef(data, wb_mult=(1., 1., 1.), verbose=False):
     2 bytes:    TIFF magic number 0x002a
     4 bytes:    TIFF offset
     n bytes:    the rest (meaning M IFDs, pixel data etc.)
+
+    Decode the IFDs and the Makernote and return
+        (ifds, makernote_ifd, makernote_abs_offset)
+    where `ifds` is an IFDList: its `tags` index covers the Makernote too.
     """
     # Make sure that the file is big-endian. If not, then we have a problem
     # since NEFs are always supposed to be big-endian...
-    if(data.read(2) != 'MM'):
+    if(data.read(2) != b'MM'):
         data.close()
         raise(Exception('File is little-endian. Are you sure it is a NEF?'))
     if(verbose == 2):
@@ -566,6 +1090,9 @@ def decode_nef(data, wb_mult=(1., 1., 1.), verbose=False):
                       makernote_tag=EXIF_TAGS[MAKERNOTE_TAG_ID],
                       verbose=verbose)
 
+    # Index the tags for quick lookups.
+    ifds = IFDList(ifds)
+
     # Get the Makernote offset. If we do not have it, we are in trouble.
     makernote_abs_offset = get_tag_value(ifds,
                                          tag_id=MAKERNOTE_TAG_ID,
@@ -574,6 +1101,25 @@ def decode_nef(data, wb_mult=(1., 1., 1.), verbose=False):
     makernote_ifd = decode_makernote(data,
                                      initial_offset=makernote_abs_offset,
                                      verbose=verbose)
+    for tag_id, entry in makernote_ifd.items():
+        ifds.tags[(MAKERNOTE_ROLE, tag_id)] = entry
+
+    return(ifds, makernote_ifd, makernote_abs_offset)
+
+
+def decode_nef(data, wb_mult=(1., 1., 1.), verbose=False, roi=None,
+               dtype=numpy.double, stats=None, demosaic=True, max_memory=None):
+    """
+    Decode the NEF in `data` (see decode_tags and decode_pixel_data) and return
+        (ifds, makernote_ifd, raster)
+    where `ifds` is an IFDList, whose `tags` index makes get_tag_value on it a
+    dictionary lookup.
+
+    If `roi` = (x, y, w, h) is given, the returned raster only covers that
+    region of the image. `dtype` is the type of the raster. See
+    decode_pixel_data for `stats`, `demosaic` and `max_memory`.
+    """
+    (ifds, makernote_ifd, makernote_abs_offset) = decode_tags(data, verbose)
 
     # Get the RAW image bits per sample value, size etc.
     raw_info = get_raw_image_info(ifds, verbose=verbose)
@@ -585,11 +1131,208 @@ def decode_nef(data, wb_mult=(1., 1., 1.), verbose=False):
                                makernote_ifd,
                                makernote_abs_offset,
                                wb_mult,
-                               verbose=verbose)
+                               roi=roi,
+                               dtype=dtype,
+                               verbose=verbose,
+                               stats=stats,
+                               demosaic=demosaic,
+                               max_memory=max_memory)
 
     return(ifds, makernote_ifd, raster)
 
 
+class NEFFile(object):
+    """
+    A NEF file, decoded lazily and only once:
+
+        with NEFFile('foo.nef') as nef:
+            nef.tags                    # tag index (parses the IFDs)
+            nef.raw                     # CFA mosaic (decodes the raw data)
+            nef.stats                   # raw statistics (idem)
+            nef.rgb(wb=(2., 1., 1.5))   # demosaiced image
+            nef.export('foo.nefraw')    # raw archive (see rawarchive)
+
+    The file is opened once and memory mapped. Each stage is computed the first
+    time it is needed and its result is kept: e.g. asking for several
+    renditions of the same file only re-does the white balance and scaling.
+    Only the last rendition is kept, so that memory does not grow with the
+    number of white balances tried. Arrays returned by `raw` and `rgb` are shared with the cache and should not
+    be modified in place.
+
+    Use it as a context manager or call close to release the file and all the
+    cached data.
+
+    `dtype` is the type of the demosaiced images (numpy.float32 or
+    numpy.double). The raw mosaic is always uint16.
+    """
+    def __init__(self, file_name, dtype=numpy.double, verbose=False):
+        self.file_name = file_name
+        self.dtype = check_dtype(dtype)
+        self.verbose = verbose
+        self.file = open(file_name, 'rb')
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except:
+            self.file.close()
+            raise
+        self.clear()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return(False)
+
+    def clear(self):
+        """
+        Forget all the decoded data.
+        """
+        self._ifds = None
+        self._makernote_ifd = None
+        self._raw_info = None
+        self._linearization = None
+        self._raw = None
+        self._stats = None
+        self._planes = None
+        self._rendition = None
+
+    def close(self):
+        """
+        Release the cached data, the memory map and the file.
+        """
+        self.clear()
+        if(self.data is not None):
+            self.data.close()
+            self.data = None
+        if(self.file is not None):
+            self.file.close()
+            self.file = None
+
+    def parse(self):
+        # Decode the IFDs and the Makernote, if needed.
+        if(self._ifds is None):
+            self.data.seek(0, os.SEEK_SET)
+            (self._ifds,
+             self._makernote_ifd,
+             makernote_abs_offset) = decode_tags(self.data, self.verbose)
+
+    @property
+    def ifds(self):
+        """
+        The list of IFDs (an IFDList, see decode_tags).
+        """
+        self.parse()
+        return(self._ifds)
+
+    @property
+    def makernote_ifd(self):
+        """
+        The Nikon Makernote IFD (see decode_makernote).
+        """
+        self.parse()
+        return(self._makernote_ifd)
+
+    @property
+    def tags(self):
+        """
+        The tag index of the IFDs (see IFDList). Makernote tags are indexed
+        under MAKERNOTE_ROLE only, since their IDs clash with EXIF ones.
+        """
+        return(self.ifds.tags)
+
+    @property
+    def raw_info(self):
+        """
+        The raw image info (see get_raw_image_info).
+        """
+        if(self._raw_info is None):
+            self._raw_info = get_raw_image_info(self.ifds, verbose=self.verbose)
+        return(self._raw_info)
+
+    @property
+    def linearization(self):
+        """
+        The raw data decoding parameters (see get_linearization).
+        """
+        if(self._linearization is None):
+            self._linearization = get_linearization(self.data,
+                                                    self.raw_info,
+                                                    self.makernote_ifd)
+        return(self._linearization)
+
+    @property
+    def raw(self):
+        """
+        The linearized CFA mosaic (see decode_mosaic).
+        """
+        if(self._raw is None):
+            hists = numpy.zeros(shape=(4, pixelutils.NUM_CODES),
+                                dtype=numpy.int64)
+            self._raw = decode_mosaic(self.data,
+                                      self.raw_info,
+                                      self.linearization,
+                                      hists=hists)
+            self._stats = get_raw_stats(hists,
+                                        self.linearization,
+                                        get_cfa_pattern(self.raw_info))
+        return(self._raw)
+
+    @property
+    def stats(self):
+        """
+        The raw statistics of the image (see get_raw_stats). They are gathered
+        while decoding the raw data: no demosaicing is done.
+        """
+        if(self._stats is None):
+            self.raw
+        return(self._stats)
+
+    def rgb(self, wb=(1., 1., 1.), scale=True, equalize=False):
+        """
+        The demosaiced (3, h, w) image, white balanced with the `wb`
+        coefficients and optionally scaled and equalized (see
+        pixelutils.demosaic). The last one is kept as (key, image).
+        """
+        key = (tuple(wb), bool(scale), bool(equalize))
+        if(self._rendition is None or self._rendition[0] != key):
+            if(self._planes is None):
+                self._planes = pixelutils.interpolate_mosaic(
+                    self.raw, get_cfa_pattern(self.raw_info), self.dtype)
+            # Let the previous rendition go before computing the new one.
+            self._rendition = None
+            self._rendition = (key, pixelutils.balance_channels(
+                self._planes.copy(), scale, equalize, tuple(wb)))
+        return(self._rendition[1])
+
+    def export(self, file_name, wb=None,
+               rows_per_chunk=rawarchive.ROWS_PER_CHUNK):
+        """
+        Write the raw mosaic, its CFA pattern, linearization curve, the white
+        balance coefficients `wb` and the ARCHIVE_TAG_IDS tags to the raw
+        archive `file_name` (see rawarchive.write_archive). Reading it back
+        with rawarchive.RawArchive skips the Huffman decoding altogether.
+        """
+        tags = []
+        for tag_id in ARCHIVE_TAG_IDS:
+            if(tag_id in self.tags):
+                entry = self.tags[tag_id]
+                tags.append([None, tag_id, entry[1], entry[-1]])
+        for tag_id in ARCHIVE_MAKERNOTE_TAG_IDS:
+            if((MAKERNOTE_ROLE, tag_id) in self.tags):
+                entry = self.tags[(MAKERNOTE_ROLE, tag_id)]
+                tags.append([MAKERNOTE_ROLE, tag_id, entry[1], entry[-1]])
+        return(rawarchive.write_archive(file_name,
+                                        self.raw,
+                                        get_cfa_pattern(self.raw_info),
+                                        self.linearization['curve'],
+                                        self.linearization['curve_max_len'],
+                                        wb,
+                                        tags,
+                                        rows_per_chunk))
+
+
 def decode_makernote(data, initial_offset, tags=NIKON_TAGS, verbose=False):
     """
     The Nikon Makernote has a format wich is somewhat similar to that of the
@@ -613,7 +1356,7 @@ def decode_makernote(data, initial_offset, tags=NIKON_TAGS, verbose=False):
 
     # Make sure that the file is big-endian. If not, then we have a problem
     # since NEFs are always supposed to be big-endian...
-    if(data.read(2) != 'MM'):
+    if(data.read(2) != b'MM'):
         data.close()
         raise(Exception('File is little-endian. Are you sure it is a NEF?'))
     if(verbose == 2):
@@ -637,6 +1380,7 @@ def decode_makernote(data, initial_offset, tags=NIKON_TAGS, verbose=False):
                                    makernote_tag=None,
                                    base_offset=base_offset,
                                    verbose=verbose)
+    makernote_ifd.role = MAKERNOTE_ROLE
     return(makernote_ifd)
 
 
@@ -670,15 +1414,23 @@ def decode_ifd(data,
     #   10  signed rational
     #   11  float
     #   12  double
+    #
+    # The whole entry table is read at once and decoded as an array of
+    # IFD_ENTRY_DTYPE. Values longer than 4 bytes are stored elsewhere: they are
+    # read in offset order, merging reads of values close to each other.
+    #
+    # Return a list of IFD instances, whose role is EXIF_ROLE for the IFD
+    # pointed to by the EXIF tag and is otherwise derived from the image type
+    # tag (RAW_ROLE or PREVIEW_ROLE).
     dirs = []
 
     # We usually have 4 child IFDs: EXIF, Preview, Raw and Makernote.
-    relative_offsets = [initial_offset, ]
+    relative_offsets = [(initial_offset, None), ]
 
     # From here below all offsets are relative to base_offset. Of course
     # base_offset is 0 for all IFDs *but* the Nikon Makernote.
     while(relative_offsets):
-        relative_offset = relative_offsets.pop()
+        relative_offset, role = relative_offsets.pop()
         abs_offset = relative_offset + base_offset
 
         if(verbose == 2):
@@ -688,61 +1440,72 @@ def decode_ifd(data,
             continue
 
         # Start parsing a new IFD.
-        dir = {}
+        dir = IFD(role, abs_offset)
         data.seek(abs_offset, os.SEEK_SET)
 
-        # Parse the directory content.
+        # Read the directory content in one go.
         n = unpack('H', data.read(2))[0]
         if(verbose == 2):
             print('N:                                           %d' %(n))
-
-        while(n):
-            if(verbose == 2):
-                print('We are at %d' % (data.tell()))
-
-            tag_id = unpack('H', data.read(2))[0]
+        table = data.read(n * 12 + 4)
+        entries = numpy.frombuffer(table, dtype=IFD_ENTRY_DTYPE, count=n)
+        typ_ids = numpy.minimum(entries['typ_id'], TYPE_SIZES.size - 1)
+        val_sizes = TYPE_SIZES[typ_ids] * entries['len'].astype(numpy.int64)
+
+        # From here on we work on plain Python ints: indexing numpy arrays one
+        # element at a time is slower than parsing the entries one by one.
+        tag_ids = entries['tag_id'].tolist()
+        typ_ids = entries['typ_id'].tolist()
+        lens = entries['len'].tolist()
+        values = entries['value'].tolist()
+        val_sizes = val_sizes.tolist()
+
+        # Fetch the values that are not in the table itself, in offset order.
+        # Special handling for the Marker Note: we do not read the value, but
+        # rather just store the offset as value.
+        unpack_bytes = {}
+        outside = [i for i in range(n)
+                   if(val_sizes[i] > 4 and
+                      (not makernote_tag or
+                       tags.get(tag_ids[i]) != makernote_tag))]
+        outside.sort(key=values.__getitem__)
+        chunks = []                             # [[start, end, [i, ...]], ...]
+        for i in outside:
+            start = values[i] + base_offset
+            end = start + val_sizes[i]
+            if(chunks and start <= chunks[-1][1] + MAX_READ_GAP):
+                chunks[-1][1] = max(chunks[-1][1], end)
+                chunks[-1][2].append(i)
+            else:
+                chunks.append([start, end, [i, ]])
+        for (start, end, members) in chunks:
+            data.seek(start, os.SEEK_SET)
+            chunk = data.read(end - start)
+            for i in members:
+                i_start = values[i] + base_offset - start
+                unpack_bytes[i] = chunk[i_start:i_start + val_sizes[i]]
+
+        for i in range(n):
+            tag_id = tag_ids[i]
             tag = tags.get(tag_id, 'Unknown Tag')
-            typ_id = unpack('H', data.read(2))[0]
-            typ_fmt, typ_size = TYPES.get(typ_id, DEF_TYPE)
-            len = unpack('I', data.read(4))[0]
-            val_abs_offset = data.tell()
+            typ_fmt, typ_size = TYPES.get(typ_ids[i], DEF_TYPE)
+            len = lens[i]
+            val_size = val_sizes[i]
 
             unpack_fmt = typ_fmt
             if(typ_fmt != None and not typ_fmt[0] == '_'):
                 unpack_fmt = len * typ_fmt
 
-            unpack_bytes = []
-            val_size = typ_size * len
             if(val_size > 4):
-                new_relative_offset = unpack('I', data.read(4))[0]
-                new_abs_offset = new_relative_offset + base_offset
-                val_abs_offset = new_abs_offset
-
-                # Special handling for the Marker Note: we do not store the
-                # value, but rather just the offset as value.
-                if(makernote_tag and tag == makernote_tag):
-                    dir[tag_id] = [new_abs_offset, tag, typ_fmt, len,
-                                   new_abs_offset]
-                    # Decrement n and go to the next entry.
-                    n -= 1
+                val_abs_offset = values[i] + base_offset
+                if(i not in unpack_bytes):
+                    # The Makernote.
+                    dir[tag_id] = [val_abs_offset, tag, typ_fmt, len,
+                                   val_abs_offset]
                     continue
-
-                # Go there...
-                here = data.tell()
-                data.seek(new_abs_offset, os.SEEK_SET)
-                if(verbose == 2):
-                    print('Jump to %d' % (new_abs_offset))
-
-                # Read the data to decode.
-                unpack_bytes = data.read(val_size)
-
-                # ...and back.
-                data.seek(here, os.SEEK_SET)
-                if(verbose == 2):
-                    print('Jump back')
             else:
-                # Read the data to decode (4 bytes in this case).
-                unpack_bytes = data.read(4)
+                val_abs_offset = abs_offset + 2 + 12 * i + 8
+                unpack_bytes[i] = table[12 * i + 8:12 * i + 12]
 
                 # Do we need padding (only if the data size would be < 4 bytes)?
                 if(val_size < 4 and
@@ -752,11 +1515,14 @@ def decode_ifd(data,
                     unpack_fmt += pad
 
             # Decode the tag value. This is always a tuple/list.
-            val = unpack(unpack_fmt, unpack_bytes)
+            val = unpack(unpack_fmt, unpack_bytes[i])
 
             # Did we get one of the child offsets?
             if(tag_id in CHILD_IFD_TAGS):
-                relative_offsets += val
+                child_role = None
+                if(tag_id == EXIF_IFD_TAG_ID):
+                    child_role = EXIF_ROLE
+                relative_offsets += [(o, child_role) for o in val]
 
             # Make sure that if len == 1, we only store the value, not a
             # singleton.
@@ -765,19 +1531,23 @@ def decode_ifd(data,
 
             # Add the tag to the current directory.
             dir[tag_id] = [val_abs_offset, tag, typ_fmt, len, val]
-
-            # Decrement the number of entries.
-            n -= 1
             if(verbose):
                 print(VERBOSE_TAG_FMT % (tag_id, tag, typ_fmt, len, val))
 
+        # Image IFDs are either the raw image or one of the previews.
+        if(dir.role is None and IMAGE_TYPE_TAG_ID in dir):
+            if(dir[IMAGE_TYPE_TAG_ID][-1] == RAW_IMAGE_TYPE):
+                dir.role = RAW_ROLE
+            else:
+                dir.role = PREVIEW_ROLE
+
         # Add the current directory to the list of directories.
         dirs.append(dir)
 
         # Get a new offset and start over.
-        new_relative_offset = unpack('I', data.read(4))[0]
+        new_relative_offset = unpack('I', table[n * 12:n * 12 + 4])[0]
         if(new_relative_offset != 0):
-            relative_offsets.append(new_offset)
+            relative_offsets.append((new_relative_offset, role))
     return(dirs)
 
 
@@ -793,8 +1563,6 @@ if(__name__ == '__main__'):
     import optparse
     import sys
 
-    from libtiff import TIFF
-
 
 
     # Constants
@@ -807,16 +1575,30 @@ converted to TIFF and simply printed to STDOUT.
 
 Usage
     nef_decoder.py [options] <NEF file name>
+    nef_decoder.py [options] -o <output dir> <NEF file name> ...
 
 
 Options
     -v          verbose (default not vcerbose)
     -o FILE     write the output to FILE. Output type is inferred from file
-                extension.
+                extension: FILE.dzi writes a Deep Zoom tile pyramid. With more
+                than one input file, FILE is a directory.
+    --ext EXT   output type (tif or dzi) with more than one input file (default
+                tif).
+    --prefetch K read up to K files ahead while decoding (default 2, 0 to
+                disable).
+    --max-memory MB decode images that would need more than MB megabytes out
+                of core (see decode_pixel_data).
+    --tiles FMT tile format for Deep Zoom output (png or jpg, default png).
     --wb        "r g b" RGB multiplication coefficient for white balance.
+    --roi       "x y w h" only decode the w x h region at (x, y).
+    --float32   process the image in single rather than double precision.
+    --stats     print the raw statistics of the image (see get_raw_stats). If
+                no output file is given, the image is not demosaiced.
 
 Example
     nef_decoder.py -o bar.jpg foo.nef
+    nef_decoder.py --prefetch 4 -o out_dir *.nef
 """
     # Get user input (tracks file) and make sure that it exists.
     parser = optparse.OptionParser(USAGE)
@@ -830,6 +1612,41 @@ Example
                       type='str',
                       default='1. 1. 1.',
                       help='white balance coefficients.')
+    parser.add_option('--tiles',
+                      dest='tile_format',
+                      type='str',
+                      default='png',
+                      help='tile format for Deep Zoom output.')
+    parser.add_option('--roi',
+                      dest='roi',
+                      type='str',
+                      default=None,
+                      help='region of interest to decode.')
+    parser.add_option('--float32',
+                      action='store_true',
+                      dest='float32',
+                      default=False,
+                      help='use single precision.')
+    parser.add_option('--stats',
+                      action='store_true',
+                      dest='stats',
+                      default=False,
+                      help='print the raw statistics.')
+    parser.add_option('--ext',
+                      dest='ext',
+                      type='str',
+                      default='tif',
+                      help='output type with more than one input file.')
+    parser.add_option('--prefetch',
+                      dest='prefetch',
+                      type='int',
+                      default=prefetch.DEPTH,
+                      help='number of files to read ahead.')
+    parser.add_option('--max-memory',
+                      dest='max_memory',
+                      type='float',
+                      default=None,
+                      help='memory budget in MB.')
     # Verbose flag
     parser.add_option('-v',
                       action='store_true',
@@ -845,12 +1662,26 @@ Example
     # Get the command line options and also whatever is passed on STDIN.
     (options, args) = parser.parse_args()
 
-    # We have to have an input file name!
-    if(not args or not os.path.exists(args[0])):
+    # We have to have input file names!
+    if(not args):
         parser.error('Please specify an input file.')
-    # And an output file name!
-    if(not options.output_name):
+    for file_name in args:
+        if(not os.path.exists(file_name)):
+            parser.error('Input file %s does not exist.' % (file_name))
+    # And an output file name, unless we only want the statistics!
+    if(not options.output_name and not options.stats):
         parser.error('Please specify the ouput file name.')
+    # With more than one input file, the output is a directory.
+    output_names = {}
+    if(options.output_name and len(args) > 1):
+        if(not os.path.isdir(options.output_name)):
+            os.makedirs(options.output_name)
+        for file_name in args:
+            base = os.path.splitext(os.path.basename(file_name))[0]
+            output_names[file_name] = os.path.join(options.output_name,
+                                                   base + '.' + options.ext)
+    elif(options.output_name):
+        output_names[args[0]] = options.output_name
 
     # Parse the white balance coefficients.
     wb_mult = (1., 1., 1.)
@@ -860,21 +1691,91 @@ Example
         except:
             parser.error('Unable to parse the white balance coefficients.')
 
-    # Convert the input file.
+    # Parse the region of interest.
+    roi = None
+    if(options.roi):
+        try:
+            roi = tuple([int(x) for x in options.roi.split()])
+        except:
+            parser.error('Unable to parse the region of interest.')
+        if(len(roi) != 4):
+            parser.error('The region of interest needs 4 values: x y w h.')
+
+    dtype = numpy.double
+    if(options.float32):
+        dtype = numpy.float32
+
+    demosaic = options.output_name is not None
+
+    max_memory = None
+    if(options.max_memory is not None):
+        max_memory = int(options.max_memory * 2**20)
+
+
+    def print_stats(stats):
+        # Print the raw statistics, one line per CFA position.
+        print('Saturation:  %d' % (stats['saturation']))
+        print('color  min    max    black  white  clipped')
+        for k in range(4):
+            print('%s      %-6d %-6d %-6d %-6d %d (%.3f%%)' \
+                  % (COLOR_NAMES[stats['colors'][k]],
+                     stats['min'][k],
+                     stats['max'][k],
+                     stats['black'][k],
+                     stats['white'][k],
+                     stats['clipped'][k],
+                     100. * stats['clipped'][k] / max(1, stats['count'][k])))
+
+
+    def write_output(img, output_name):
+        # Write the resulting image.
+        # TODO: handle the metadata!
+        if(os.path.splitext(output_name)[1].lower() == '.dzi'):
+            import pyramid
+
+            pyramid.write_pyramid(img, output_name,
+                                  tile_format=options.tile_format)
+            return
+
+        from libtiff import TIFF
+
+        tif = TIFF.open(output_name, mode='w')
+        tif.write_image(img.astype(numpy.uint16), write_rgb=True)
+        tif.close()
+
+
+    def convert():
+        # Convert the input files. Return the number of failures. The peak RSS
+        # of each file covers its decoding and the writing of its output.
+        failures = 0
+        reset_peak_rss()
+        for (file_name, output, stats, error) in decode_files(
+                args, wb_mult, verbose=options.verbose, roi=roi,
+                dtype=dtype, stats=options.stats, demosaic=demosaic,
+                depth=options.prefetch, max_memory=max_memory):
+            if(error is not None):
+                print('%s: %s' % (file_name, error))
+                failures += 1
+                reset_peak_rss()
+                continue
+            if(len(args) > 1 and stats is not None):
+                print(file_name)
+            if(stats is not None):
+                print_stats(stats)
+            if(demosaic):
+                write_output(output[2], output_names[file_name])
+            del(output)
+            print('%s: peak RSS %.1f MB' % (file_name, get_peak_rss() / 2.**20))
+            reset_peak_rss()
+        return(failures)
+
+
     if(options.profile):
         import cProfile
 
         print('Profiler on')
-        cmd = 'metadata, makernote, img = decode_file(args[0], wb_mult, verbose=options.verbose)'
-        cProfile.runctx(cmd, globals(), locals(), filename="nef_decoder.prof" )
+        cProfile.run('failures = convert()', filename="nef_decoder.prof")
     else:
         print('Profiler off')
-        metadata, makernote, img = decode_file(args[0], wb_mult, verbose=options.verbose)
-
-    # Write the resulting image.
-    # TODO: handle the metadata!
-    tif = TIFF.open(options.output_name, mode='w')
-    tif.write_image(img.astype(numpy.uint16), write_rgb=True)
-    tif.close()
-    sys.exit(0)
-
+        failures = convert()
+    sys.exit(int(failures > 0))
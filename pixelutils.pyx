@@ -1,8 +1,23 @@
-# cython: profile=False
+import os
+from multiprocessing import cpu_count
+
 import numpy
 cimport numpy
 # cimport cython
 from cpython cimport bool
+from cython.parallel cimport prange
+
+
+# Pixel types. The CFA mosaic holds 12 to 16 bit integers and can be stored 
+# exactly as uint16; everything after demosaicing is float or double.
+ctypedef fused mosaic_t:
+    numpy.uint16_t
+    float
+    double
+
+ctypedef fused real_t:
+    float
+    double
 
 
 # Utility routines.
@@ -14,7 +29,7 @@ cdef inline int int_boxit_fast(int x, int low, int high):
     return(x)
 
 
-cdef inline double double_boxit_fast(double x, double low, double high):
+cdef inline double double_boxit_fast(double x, double low, double high) nogil:
     if(x < low):
         return(low)
     elif(x > high):
@@ -22,26 +37,81 @@ cdef inline double double_boxit_fast(double x, double low, double high):
     return(x)
 
 
-cdef inline int bintoint(char* bin, int f, int l):
-    # Convert the binary string `bin` of length `len` into an integer.
-    # We assume that bin is a string composed of '1's and '0's only but we do 
-    # not check (for performance reasons).
-    cdef Py_ssize_t  k
-    cdef int  sum = 0
-    cdef unsigned short i
+cdef inline Py_ssize_t band_start(Py_ssize_t band, 
+                                  Py_ssize_t num_bands, 
+                                  Py_ssize_t h) nogil:
+    # First row of band number `band` when splitting `h` rows in `num_bands` 
+    # bands of (almost) the same size.
+    return(band * h // num_bands)
+
+
+def get_num_bands(threads, Py_ssize_t h):
+    """
+    Number of bands of rows to split an image of height `h` in to process it 
+    on `threads` threads (default: OMP_NUM_THREADS if set, otherwise one per 
+    CPU): one band per thread.
     
-    for k from f <= k < f+l:
-        i = <unsigned int>bin[k]
-        sum = sum + i * (1 << (l-k-1+f))
-    return(sum)
+    OMP_NUM_THREADS can be a list of thread counts, one per nesting level 
+    (e.g. "8,4"): we use the first one. Values that are not a positive number 
+    are ignored.
+    """
+    if(not threads):
+        try:
+            threads = int(os.environ.get('OMP_NUM_THREADS', '').split(',')[0])
+        except ValueError:
+            threads = 0
+        if(threads <= 0):
+            threads = cpu_count()
+    return(max(1, min(threads, h)))
+
+
+cdef inline unsigned int peek_bits(unsigned char* buffer, 
+                                  Py_ssize_t num_bytes, 
+                                  Py_ssize_t position, 
+                                  int n) nogil:
+    # Return the `n` (1 <= n <= 25) bits of `buffer` starting at bit `position`
+    # (most significant bit first) as an integer. Bits past the end of the 
+    # buffer are 0.
+    cdef Py_ssize_t k = position >> 3
+    cdef Py_ssize_t i
+    cdef unsigned int word = 0
+    
+    if(k + 4 <= num_bytes):
+        word = ((<unsigned int>buffer[k] << 24) | 
+                (<unsigned int>buffer[k+1] << 16) | 
+                (<unsigned int>buffer[k+2] << 8) | 
+                <unsigned int>buffer[k+3])
+    else:
+        for i in range(k, k + 4):
+            word <<= 8
+            if(i < num_bytes):
+                word |= buffer[i]
+    return((word << (position & 7)) >> (32 - n))
+
+
+# Bayer CFA patterns, as stored in the CFA Pattern 2 tag (0x828e): the color of
+# the top-left 2x2 pixels in row major order (0=R, 1=G, 2=B). For each of them 
+# we store the (row, column) steps of the view of the image in which the 
+# pattern becomes B G / G R, which is what `demosaic` knows how to handle.
+CFA_PHASES = {(2, 1, 1, 0): (1, 1),         # B G / G R
+              (1, 2, 0, 1): (1, -1),        # G B / R G
+              (1, 0, 2, 1): (-1, 1),        # G R / B G
+              (0, 1, 1, 2): (-1, -1)}       # R G / G B
+
+
+# Number of bins of the raw code histograms: codes are at most 14 bit.
+NUM_CODES = 0x4000
 
 
 # @cython.boundscheck(True)
-def compute_pixel_values(numpy.ndarray[numpy.double_t, ndim=2] deltas, 
+def compute_pixel_values(numpy.ndarray[numpy.int32_t, ndim=2] deltas, 
                          list horiz_preds, 
                          list vert_preds, 
-                         tuple curve, 
-                         int left_margin=0):
+                         curve, 
+                         dtype=numpy.double, 
+                         hists=None, 
+                         out=None, 
+                         tuple hist_cols=None):
     """
     First take the first column and, starting from the bottom (actally the 
     second to last pixel) and going up, add to each delta the value immediately 
@@ -50,53 +120,199 @@ def compute_pixel_values(numpy.ndarray[numpy.double_t, ndim=2] deltas,
     Then, for every row, starting from the left (again, from the second item) 
     and going right, add to each delta the value immediately to its left.
     
-    What you get are the linearity corrected pixel values. You should really do 
-    it color by color.
-    """
-    # TODO: This has to computed from the CFA Pattern 2 tag value!
-    filters = 0x1e1e1e1e
+    What you get are the linearity corrected pixel values, which are returned 
+    as a single (h, w) plane of type `dtype` (uint16, float32 or float64): the 
+    CFA mosaic. Predictors work on same-parity columns (and rows) so that 
+    differences are done color by color whatever the CFA pattern. Use 
+    `bayer_planes` or `demosaic` to split the colors.
     
+    If `hists` is a (4, NUM_CODES) int64 array, also add to it the histogram of
+    the raw codes (i.e. the curve indices) of each of the 4 CFA positions, in 
+    row major order. If `hist_cols` = (start, end) is given, only the pixels of
+    columns [start, end) are counted.
+    
+    If `out` is given (a zeroed (h, w) array of type `dtype`, e.g. a 
+    numpy.memmap), the pixel values are written there.
+    """
+    if(out is None):
+        pixels = numpy.zeros(shape=(deltas.shape[0], deltas.shape[1]), 
+                             dtype=dtype)
+    elif(out.shape != (deltas.shape[0], deltas.shape[1]) or 
+         out.dtype != numpy.dtype(dtype)):
+        raise(ValueError('out must be a (%d, %d) %s array.' \
+                         % (deltas.shape[0], deltas.shape[1], 
+                            numpy.dtype(dtype).name)))
+    else:
+        pixels = out
+    fill_pixel_values(deltas, 
+                      numpy.array(horiz_preds, dtype=numpy.int32), 
+                      numpy.array(vert_preds, dtype=numpy.int32), 
+                      numpy.asarray(curve, dtype=dtype), 
+                      pixels, 
+                      hists, 
+                      hist_cols)
+    return(pixels)
+
+
+def fill_pixel_values(numpy.ndarray[numpy.int32_t, ndim=2] deltas, 
+                      numpy.ndarray[numpy.int32_t, ndim=1] hpreds, 
+                      numpy.ndarray[numpy.int32_t, ndim=2] vpreds, 
+                      numpy.ndarray[mosaic_t, ndim=1] lut, 
+                      numpy.ndarray[mosaic_t, ndim=2] pixels, 
+                      hists=None, 
+                      tuple hist_cols=None):
+    """
+    The actual work of `compute_pixel_values`, for each pixel type. The 
+    predictors `hpreds` and `vpreds` are modified in place.
+    """
     cdef Py_ssize_t h = deltas.shape[0]
     cdef Py_ssize_t w = deltas.shape[1]
     cdef Py_ssize_t real_width = w - 1
     cdef Py_ssize_t row = 0
     cdef Py_ssize_t col = 0
-    cdef Py_ssize_t c = 0
-    cdef Py_ssize_t v = 0
-    cdef int curve_len = len(curve) - 1
-    cdef numpy.ndarray[numpy.double_t, ndim=3] pixels = numpy.zeros(shape=(3, h, w), 
-                                                                    dtype=numpy.double)
-    cdef numpy.ndarray[numpy.double_t, ndim=2] vpreds = numpy.array(vert_preds, 
-                                                                    dtype=numpy.double)
-    cdef numpy.ndarray[numpy.double_t, ndim=1] hpreds = numpy.array(horiz_preds, 
-                                                                    dtype=numpy.double)
-    
-    # Now, the algorithm above returns colors in RGBG instead of RGBA, so we 
-    # have to add plane 3 to plane 1.
+    cdef int curve_max = min(NUM_CODES - 1, lut.shape[0] - 1)
+    cdef int code
+    cdef bint count = hists is not None
+    cdef numpy.ndarray[numpy.int64_t, ndim=2] counts = hists
+    cdef Py_ssize_t count_start = 0
+    cdef Py_ssize_t count_end = w
+    
+    if(count and (counts.shape[0] != 4 or counts.shape[1] < curve_max + 1)):
+        raise(ValueError('hists must be a (4, %d) array.' % (NUM_CODES)))
+    if(hist_cols is not None):
+        count_start, count_end = hist_cols
+    
     for row in range(h):
-        for col in range(w):
-            if(col < 2):
-                vpreds[row & 1][col] += deltas[row, col]
-                hpreds[col] = vpreds[row & 1][col]
-            else:
-                hpreds[col & 1] += deltas[row, col]
-            
+        for col in range(min(2, w)):
+            vpreds[row & 1, col] += deltas[row, col]
+            hpreds[col] = vpreds[row & 1, col]
             if(col < real_width):
-                c = (filters >> ((((row) << 1 & 14) + ((col-left_margin) & 1)) << 1) & 3)
-                v = curve[<int>double_boxit_fast(hpreds[col & 1], 0, 0x3fff)]
-                if(c == 3):
-                    c = 1
-                pixels[c, row, col] = <double>v
+                code = int_boxit_fast(hpreds[col], 0, curve_max)
+                pixels[row, col] = lut[code]
+                if(count and count_start <= col < count_end):
+                    counts[((row & 1) << 1) | col, code] += 1
+        for col in range(2, real_width):
+            hpreds[col & 1] += deltas[row, col]
+            code = int_boxit_fast(hpreds[col & 1], 0, curve_max)
+            pixels[row, col] = lut[code]
+            if(count and count_start <= col < count_end):
+                counts[((row & 1) << 1) | (col & 1), code] += 1
     return(pixels)
 
 
+def bayer_planes(mosaic, 
+                 tuple cfa_pattern=(2, 1, 1, 0), 
+                 dtype=numpy.double):
+    """
+    Split the CFA `mosaic` into a (3, h, w) array of R, G and B planes of type
+    `dtype`. Each plane has the values of its color where the `cfa_pattern` 
+    (see `CFA_PHASES`) has that color and 0 everywhere else.
+    """
+    cdef int k
+    
+    if(cfa_pattern not in CFA_PHASES):
+        raise(NotImplementedError('Unsupported CFA pattern %s.' \
+                                  % (str(cfa_pattern))))
+    
+    pixels = numpy.zeros(shape=(3, mosaic.shape[0], mosaic.shape[1]), 
+                         dtype=dtype)
+    for k in range(4):
+        pixels[cfa_pattern[k], k >> 1::2, k & 1::2] = mosaic[k >> 1::2, k & 1::2]
+    return(pixels)
+
+
+# Cache of the Huffman tables as C friendly arrays:
+#   {tree_index: (trees, num_bits, table)}
+# We keep a reference to the list of trees the table comes from: the table is
+# only reused for that very list.
+cdef dict HUFFMAN_TABLES = {}
+
+
+def huffman_table(list NIKON_TREE, int tree_index):
+    """
+    Return (num_bits, table) for the Huffman tree `NIKON_TREE[tree_index]`. 
+    `table` is a contiguous (2**num_bits, 4) int32 array whose rows are 
+        (bits_used, length, correction, length-correction)
+    see huffman_tables.py.
+    """
+    entry = HUFFMAN_TABLES.get(tree_index)
+    if(entry is None or entry[0] is not NIKON_TREE):
+        num_bits, tree = NIKON_TREE[tree_index]
+        entry = (NIKON_TREE, num_bits, numpy.array(tree, dtype=numpy.int32))
+        HUFFMAN_TABLES[tree_index] = entry
+    return(entry[1:])
+
+
+cdef Py_ssize_t decode_rows(unsigned char* buffer, 
+                            Py_ssize_t num_bytes, 
+                            Py_ssize_t position, 
+                            int num_bits, 
+                            int* tree, 
+                            Py_ssize_t row_start, 
+                            Py_ssize_t row_end, 
+                            Py_ssize_t width, 
+                            Py_ssize_t y0, 
+                            Py_ssize_t* col_map, 
+                            int* deltas, 
+                            Py_ssize_t stride) nogil:
+    # Decode the deltas of rows [row_start, row_end) starting at bit `position` 
+    # of `buffer` using the Huffman `tree` and return the bit position where we 
+    # stopped. See `decode_pixel_deltas` for `y0`, `col_map` and the layout of 
+    # `deltas` (which has `stride` columns).
+    cdef Py_ssize_t row, col, dest_col
+    cdef int* leaf
+    cdef int raw_len, corr, delta_len
+    cdef int delta
+    
+    for row in range(row_start, row_end):
+        for col in range(width):
+            # Read num_bits bits from the buffer and interpret them as an index 
+            # in the Huffman tree, which gives us a bunch of stuff:
+            #  - The length in bits of the acual data on the tree.
+            #  - The length in bits of the pixel delta (in binary form).
+            #  - Any correction to the length above.
+            # Conveniently, the trees in huffman_tables.py already provide those
+            # numbers in the right place:
+            #  tree[i] = (bits_read, length, currection, length-corection)
+            leaf = tree + 4 * peek_bits(buffer, num_bytes, position, num_bits)
+            position += leaf[0]
+            raw_len = leaf[1]
+            corr = leaf[2]
+            delta_len = leaf[3]
+            
+            # Now read delta_len bits. That, pretty much, is the difference in 
+            # value between adjacent pixel values: 
+            #  delta = pixel - pixel_to_the_left
+            # Beware that the same treatement is done vertically to the first 
+            # column.
+            if(not delta_len):
+                delta = 0
+            else:
+                delta = peek_bits(buffer, num_bytes, position, delta_len)
+                delta = ((delta << 1) + 1) << corr >> 1
+                if((delta & (1 << (raw_len - 1))) == 0):
+                    # In C !0 = 1; in Python ~0 = -1...
+                    delta -= (1 << raw_len) - (corr == 0)
+                position += delta_len
+            
+            if(row >= y0):
+                dest_col = col_map[col]
+                if(dest_col >= 0):
+                    deltas[(row - y0) * stride + dest_col] += delta
+            elif(col < 2):
+                deltas[(row & 1) * stride + col] += delta
+    return(position)
+
+
 # @cython.boundscheck(True)
 def decode_pixel_deltas(Py_ssize_t width, 
                         Py_ssize_t height, 
                         int tree_index, 
-                        numpy.ndarray[numpy.uint8_t, ndim=1] bit_buffer, 
+                        numpy.ndarray[numpy.uint8_t, ndim=1] byte_buffer, 
                         int split_row,
-                        list NIKON_TREE):
+                        list NIKON_TREE, 
+                        tuple roi=None, 
+                        out=None):
     """
     Instead of encoding the raw pixel values, NEFs encode the difference between
     each pixel and the pixel to its left (row-wise). The sam ething happens for 
@@ -105,109 +321,206 @@ def decode_pixel_deltas(Py_ssize_t width,
     binary representation is huffman encoded. What we have in the NEF is the
     huffman encoded list of delta lengths. The nice thing about huffman encoding
     is that no leaf value (in binary) is a prefix of any other value.
+    
+    `byte_buffer` holds the encoded data, as read from the file. Rows 
+    [0, split_row) are decoded with the tree `NIKON_TREE[tree_index]` and rows
+    [split_row, height) with the next one. A `split_row` <= 0 means that there 
+    is no split.
+    
+    If `roi` = (x0, y0, x1, y1) is given (x0 and y0 even), decoding stops at row 
+    y1 and only the deltas needed to reconstruct the pixels in [y0, y1) x 
+    [x0, x1) are kept. Deltas are folded so that `compute_pixel_values` on the 
+    result gives exactly the pixel values of that region:
+        - the first column deltas of rows above y0 are added to the first row 
+          of the same parity (they only feed the vertical predictors);
+        - if x0 >= 2, output columns 0 and 1 hold image columns 0 and 1 and the 
+          deltas of image columns [2, x0) are added to those of x0 and x0+1. 
+          Output column 2 is then image column x0.
+    The returned int32 array has shape 
+        (y1 - y0, x1 - x0 + (2 if x0 >= 2 else 0))
+    
+    If `out` is given (a zeroed, C contiguous int32 array of that shape, e.g. a
+    numpy.memmap), the deltas are written there.
     """
-    # Decode the pixels, one by one. This is still very confusing to me.
-    cdef int position = 0
-    cdef Py_ssize_t num_bits = 0
-    cdef list tree = []
-    cdef int len_tree = len(tree)
-    cdef int huff_idx = 0
-    cdef int num_read = 0
-    cdef int raw_len = 0
-    cdef int corr = 0
-    cdef int delta_len = 0
-    cdef int x = 0
-    cdef int delta = 0
-    cdef Py_ssize_t row = 0
+    cdef Py_ssize_t position = 0
     cdef Py_ssize_t col = 0
-    cdef numpy.ndarray[numpy.double_t, ndim=2] deltas = numpy.zeros(shape=(height, width), 
-                                                                    dtype=numpy.double)
-    cdef char* bit_buffer_ptr = <char*>bit_buffer.data
-    
-    
-    num_bits, tree = NIKON_TREE[tree_index]
-    if(split_row == -1):
-        for row in range(height):
-            for col in range(width):
-                # Read num_bits bits from the file (or wherever the data is stored),
-                # interpret them as a C unsigned char from which you can derive a
-                # bunch of stuff (using the appropriate Huffman tree):
-                #  - The length in bits of the acual data on the tree.
-                #  - The length in bits of the pixel delta (in binary form).
-                #  - Any correction to the length above.
-                # Conveniently, the trees in huffman_tables.py already provide those
-                # numbers in the right place:
-                #  tree[i] = (bits_read, length, currection, length-corection)
-                huff_idx = bintoint(bit_buffer_ptr, position, num_bits)
-                
-                (num_read, raw_len, corr, delta_len) = tree[huff_idx]
-                position += num_read
-                
-                # Now read delta_len bits. That, pretty much, is the difference in 
-                # value between adjacent pixel values: 
-                #  delta = pixel - pixel_to_the_left
-                # Beware that the same treatement is done vertically to the first 
-                # column.
-                if(not delta_len):
-                    delta = 0
-                else:
-                    x = bintoint(bit_buffer_ptr, position, delta_len)
-                    delta = ((x << 1) + 1) << corr >> 1
-                    if((delta & (1 << (raw_len - 1))) == 0 and corr == 0):
-                        # In C !0 = 1; in Python ~0 = -1...
-                        delta -= (1 << raw_len) - 1
-                    elif((delta & (1 << (raw_len - 1))) == 0 and corr != 0):
-                        delta -= (1 << raw_len)
-                
-                deltas[row, col] = delta
-                position += delta_len
+    cdef Py_ssize_t x0 = 0
+    cdef Py_ssize_t y0 = 0
+    cdef Py_ssize_t x1 = width
+    cdef Py_ssize_t y1 = height
+    cdef Py_ssize_t split = height
+    cdef Py_ssize_t off = 0
+    cdef int num_bits_0, num_bits_1
+    cdef numpy.ndarray[numpy.int32_t, ndim=2] tree_0, tree_1
+    cdef numpy.ndarray[numpy.int32_t, ndim=2] deltas
+    cdef numpy.ndarray[numpy.intp_t, ndim=1] col_map
+    
+    if(roi is not None):
+        x0, y0, x1, y1 = roi
+        if(x0 >= 2):
+            off = 2
+    
+    # Where each image column goes in the output (-1: nowhere).
+    col_map = numpy.empty(shape=(width, ), dtype=numpy.intp)
+    for col in range(width):
+        if(col >= x1):
+            col_map[col] = -1
+        elif(col >= x0):
+            col_map[col] = col - x0 + off
+        elif(col < 2):
+            col_map[col] = col
+        else:
+            col_map[col] = off + (col & 1)
+    if(out is None):
+        deltas = numpy.zeros(shape=(y1 - y0, x1 - x0 + off), dtype=numpy.int32)
+    elif(out.shape != (y1 - y0, x1 - x0 + off) or 
+         out.dtype != numpy.int32 or 
+         not out.flags['C_CONTIGUOUS']):
+        raise(ValueError('out must be a C contiguous (%d, %d) int32 array.' \
+                         % (y1 - y0, x1 - x0 + off)))
     else:
-        for row in range(height):
-            if(row == split_row):
-                num_bits, tree = NIKON_TREE[tree_index+1]
-            
-            for col in range(width):
-                # Read num_bits bits from the file (or wherever the data is stored),
-                # interpret them as a C unsigned char from which you can derive a
-                # bunch of stuff (using the appropriate Huffman tree):
-                #  - The length in bits of the acual data on the tree.
-                #  - The length in bits of the pixel delta (in binary form).
-                #  - Any correction to the length above.
-                # Conveniently, the trees in huffman_tables.py already provide those
-                # numbers in the right place:
-                #  tree[i] = (bits_read, length, currection, length-corection)
-                huff_idx = bintoint(bit_buffer_ptr, position, num_bits)
-                
-                (num_read, raw_len, corr, delta_len) = tree[huff_idx]
-                position += num_read
-                
-                # Now read delta_len bits. That, pretty much, is the difference in 
-                # value between adjacent pixel values: 
-                #  delta = pixel - pixel_to_the_left
-                # Beware that the same treatement is done vertically to the first 
-                # column.
-                if(not delta_len):
-                    delta = 0
-                else:
-                    x = bintoint(bit_buffer_ptr, position, delta_len)
-                    delta = ((x << 1) + 1) << corr >> 1
-                    if((delta & (1 << (raw_len - 1))) == 0 and corr == 0):
-                        # In C !0 = 1; in Python ~0 = -1...
-                        delta -= (1 << raw_len) - 1
-                    elif((delta & (1 << (raw_len - 1))) == 0 and corr != 0):
-                        delta -= (1 << raw_len)
-                
-                deltas[row, col] = delta
-                position += delta_len
+        deltas = out
+    
+    # The two segments of the image and their Huffman trees.
+    num_bits_0, tree_0 = huffman_table(NIKON_TREE, tree_index)
+    if(0 < split_row < y1):
+        split = split_row
+        num_bits_1, tree_1 = huffman_table(NIKON_TREE, tree_index + 1)
+    else:
+        split = y1
+        num_bits_1, tree_1 = num_bits_0, tree_0
+    
+    with nogil:
+        position = decode_rows(<unsigned char*>byte_buffer.data, 
+                               byte_buffer.shape[0], 
+                               position, 
+                               num_bits_0, 
+                               <int*>tree_0.data, 
+                               0, 
+                               split, 
+                               width, 
+                               y0, 
+                               <Py_ssize_t*>col_map.data, 
+                               <int*>deltas.data, 
+                               deltas.shape[1])
+        position = decode_rows(<unsigned char*>byte_buffer.data, 
+                               byte_buffer.shape[0], 
+                               position, 
+                               num_bits_1, 
+                               <int*>tree_1.data, 
+                               split, 
+                               y1, 
+                               width, 
+                               y0, 
+                               <Py_ssize_t*>col_map.data, 
+                               <int*>deltas.data, 
+                               deltas.shape[1])
     return(deltas)
 
 
-def demosaic(numpy.ndarray[numpy.double_t, ndim=3] pixels, 
+def demosaic(mosaic, 
+             tuple cfa_pattern=(2, 1, 1, 0), 
              bool scale=True, 
              bool equalize=False,
-             tuple wb_mult=(1., 1., 1.)):
+             tuple wb_mult=(1., 1., 1.), 
+             numpy.ndarray[numpy.int64_t, ndim=2] hists=None, 
+             dtype=numpy.double, 
+             threads=None):
     """
-    We assume for now that the bayer pattern is 
+    Interpolate the CFA `mosaic` (see `interpolate_mosaic`) and then white 
+    balance, scale and optionally equalize the result (see `balance_channels`)
+    on `threads` threads. Return a (3, h, w) array of type `dtype` (float32 or 
+    float64).
+    """
+    return(balance_channels(interpolate_mosaic(mosaic, cfa_pattern, dtype), 
+                            scale, 
+                            equalize, 
+                            wb_mult, 
+                            hists, 
+                            threads))
+
+
+def interpolate_mosaic(mosaic, 
+                       tuple cfa_pattern=(2, 1, 1, 0), 
+                       dtype=numpy.double):
+    """
+    Split the CFA `mosaic` in its R, G and B planes (see `bayer_planes`) and 
+    interpolate the missing values of each. Return a (3, h, w) array of type
+    `dtype` (float32 or float64).
+    
+    Image sizes are even. For any of the Bayer patterns in `CFA_PHASES` we work 
+    on a (flipped) view of the planes where the pattern becomes
+    
+        B G B G
+        G R G R
+    
+    and `interpolate_bggr` does the actual work.
+    """
+    cdef int row_step, col_step
+    
+    pixels = bayer_planes(mosaic, cfa_pattern, dtype)
+    (row_step, col_step) = CFA_PHASES[cfa_pattern]
+    if((row_step < 0 and mosaic.shape[0] % 2) or 
+       (col_step < 0 and mosaic.shape[1] % 2)):
+        raise(NotImplementedError('CFA pattern %s needs even image sizes.' \
+                                  % (str(cfa_pattern))))
+    interpolate_bggr(pixels[:, ::row_step, ::col_step])
+    return(pixels)
+
+
+def balance_channels(pixels, 
+                     bool scale=True, 
+                     bool equalize=False,
+                     tuple wb_mult=(1., 1., 1.), 
+                     numpy.ndarray[numpy.int64_t, ndim=2] hists=None, 
+                     threads=None):
+    """
+    Multiply each channel of the (3, h, w) `pixels` by its white balance 
+    coefficient in `wb_mult`. Then, if `scale` is True, scale the result to 
+    cover the whole [0, 65535] range and, if `equalize` is True, equalize its 
+    histogram.
+    
+    If `hists` is given (shape (3, 65536)), the per channel histograms of the 
+    scaled output are accumulated in it; this is done anyway when `equalize` is
+    True.
+    
+    White balance and scaling are done in a single pass. All the passes run on
+    `threads` threads (default: see `get_num_bands`), each working on a band 
+    of rows.
+    
+    We modify the array in place.
+    """
+    cdef double factor = 1.
+    
+    # Now scale it so that we cover the whole dynamic range: the maximum of the
+    # white balanced image is the largest of the balanced channel maxima. If we
+    # need to equalize, build the histograms while we are at it.
+    if(equalize and hists is None):
+        hists = numpy.zeros(shape=(3, 65536), dtype=numpy.int64)
+    if(scale):
+        factor = scale_factor(channel_maxima(pixels, threads), wb_mult)
+    if(scale or hists is not None or wb_mult != (1., 1., 1.)):
+        scale_channels(pixels, factor, hists, wb_mult, threads)
+    
+    # Do we want histogram equalization?
+    if(equalize):
+        return(histogram_equalize(pixels, hists, None, threads))
+    return(pixels)
+
+
+def scale_factor(maxima, tuple wb_mult=(1., 1., 1.)):
+    """
+    The factor that scales an image with channel `maxima` (see 
+    `channel_maxima`), white balanced with `wb_mult`, to cover the whole 
+    [0, 65535] range (see `balance_channels`).
+    """
+    return(65535. / max([wb_mult[c] * maxima[c] for c in range(len(wb_mult))]))
+
+
+def interpolate_bggr(numpy.ndarray[real_t, ndim=3] pixels):
+    """
+    Bilinear interpolation of the missing values of the (3, h, w) R, G and B 
+    planes of a Bayer image with pattern
     
         B G B G
         G R G R
@@ -266,7 +579,7 @@ def demosaic(numpy.ndarray[numpy.double_t, ndim=3] pixels,
     # Horizontals.
     for i in range(0, h, 2):
         # The last column.
-        pixels[2, i, -1] = .5 * pixels[2, i, -2]
+        pixels[2, i, w-1] = .5 * pixels[2, i, w-2]
         # The rest.
         pixels[2, i, 1:w-2:2] = .5 * (pixels[2, i, 0:w-3:2] + pixels[2, i, 2:w:2])
     # Verticals.
@@ -280,12 +593,12 @@ def demosaic(numpy.ndarray[numpy.double_t, ndim=3] pixels,
     # We determine the (interpolated) blue value at red pixel locations by 
     # interpolating the four diagonal blue values.
     # Bottom corner pixel.
-    pixels[2, -1, -1] = .25 * pixels[2, -2, -2]
+    pixels[2, h-1, w-1] = .25 * pixels[2, h-2, w-2]
     # The rest of the bottom row.
     pixels[2, -1, 1:w-2:2] = .25 * (pixels[2, -2, 0:w-3:2] + pixels[2, -2, 2:w:2])
     for i in range(1, h-2, 2):
         # Edge pixel first.
-        pixels[2, i, -1] = .25 * (pixels[2, i-1, -2] + pixels[2, i+1, -2])
+        pixels[2, i, w-1] = .25 * (pixels[2, i-1, w-2] + pixels[2, i+1, w-2])
         # All the rest.
         pixels[2, i, 1:w-2:2] = .25 * (pixels[2, i-1, 0:w-3:2] + 
                                     pixels[2, i-1, 2:w:2] + 
@@ -296,16 +609,16 @@ def demosaic(numpy.ndarray[numpy.double_t, ndim=3] pixels,
     # We determine the (interpolated) green value at red pixel locations by 
     # interpolating the four cross green values.
     # Bottom corner pixel.
-    pixels[1, -1, -1] = .25 * (pixels[1, -2, -1] + pixels[1, -1, -2])
+    pixels[1, h-1, w-1] = .25 * (pixels[1, h-2, w-1] + pixels[1, h-1, w-2])
     # The rest of the bottom row.
     pixels[1, -1, 1:w-2:2] = .25 * (pixels[1, -1, 0:w-3:2] + 
                                  pixels[1, -1, 2:w:2] + 
                                  pixels[1, -2, 1:w-2:2])
     for i in range(1, h-2, 2):
         # Edge pixel first.
-        pixels[1, i, -1] = .25 * (pixels[1, i-1, -1] + 
-                               pixels[1, i, -2] + 
-                               pixels[1, i+1, -1])
+        pixels[1, i, w-1] = .25 * (pixels[1, i-1, w-1] + 
+                                pixels[1, i, w-2] + 
+                                pixels[1, i+1, w-1])
         # All the rest.
         pixels[1, i, 1:w-2:2] = .25 * (pixels[1, i-1, 1:w-2:2] + 
                                     pixels[1, i, 0:w-3:2] + 
@@ -330,71 +643,276 @@ def demosaic(numpy.ndarray[numpy.double_t, ndim=3] pixels,
                                   pixels[1, i, 1:w-2:2] + 
                                   pixels[1, i, 3:w:2] + 
                                   pixels[1, i+1, 2:w:2])
+    return(pixels)
+
+
+# Band kernels for the post-demosaic passes: each works on rows [start, end) of 
+# the n channels of a (n, h, w) array with data pointer `data` and byte 
+# `strides`, without the GIL.
+cdef void max_rows(real_t* data, 
+                   Py_ssize_t* strides, 
+                   Py_ssize_t n, 
+                   Py_ssize_t start, 
+                   Py_ssize_t end, 
+                   Py_ssize_t w, 
+                   double* maxima) noexcept nogil:
+    # Update the n `maxima` with those of the rows.
+    cdef Py_ssize_t c, i, j
+    cdef Py_ssize_t s2 = strides[2]
+    cdef char* row
+    cdef double m, v
     
-    # Correct for white balance.
-    pixels[0] *= wb_mult[0]
-    pixels[1] *= wb_mult[1]
-    pixels[2] *= wb_mult[2]
+    for c in range(n):
+        m = maxima[c]
+        for i in range(start, end):
+            row = <char*>data + c * strides[0] + i * strides[1]
+            for j in range(w):
+                v = (<real_t*>(row + j * s2))[0]
+                if(v > m):
+                    m = v
+        maxima[c] = m
+
+
+cdef void count_rows(real_t* data, 
+                     Py_ssize_t* strides, 
+                     Py_ssize_t n, 
+                     Py_ssize_t start, 
+                     Py_ssize_t end, 
+                     Py_ssize_t w, 
+                     numpy.int32_t* counts) noexcept nogil:
+    # Add the values of the rows to the (n, 65536) histograms `counts`.
+    cdef Py_ssize_t c, i, j
+    cdef Py_ssize_t s2 = strides[2]
+    cdef char* row
     
-    # Now scale it so that we cover the whole dynamic range.
-    if(scale):
-        pixels *= 65535. / pixels.max()
+    for c in range(n):
+        for i in range(start, end):
+            row = <char*>data + c * strides[0] + i * strides[1]
+            for j in range(w):
+                counts[c * 65536 + <int>double_boxit_fast(
+                    (<real_t*>(row + j * s2))[0], 0., 65535.)] += 1
+
+
+cdef void scale_rows(real_t* data, 
+                     Py_ssize_t* strides, 
+                     Py_ssize_t n, 
+                     Py_ssize_t start, 
+                     Py_ssize_t end, 
+                     Py_ssize_t w, 
+                     double* mult, 
+                     double factor, 
+                     numpy.int32_t* counts) noexcept nogil:
+    # Multiply channel c of the rows by mult[c] and then by `factor`. Count the
+    # results in the (n, 65536) histograms `counts` unless it is NULL.
+    cdef Py_ssize_t c, i, j
+    cdef Py_ssize_t s2 = strides[2]
+    cdef char* row
+    cdef real_t* p
+    cdef real_t v
     
-    # Do we want histogram equalization?
-    if(equalize):
-        return(histogram_equalize(pixels))
+    for c in range(n):
+        for i in range(start, end):
+            row = <char*>data + c * strides[0] + i * strides[1]
+            for j in range(w):
+                p = <real_t*>(row + j * s2)
+                v = p[0] * mult[c]
+                v = v * factor
+                p[0] = v
+                if(counts != NULL):
+                    counts[c * 65536 + <int>double_boxit_fast(v, 0., 
+                                                              65535.)] += 1
+
+
+cdef void lookup_rows(real_t* data, 
+                      Py_ssize_t* strides, 
+                      real_t* dest, 
+                      Py_ssize_t* dest_strides, 
+                      Py_ssize_t n, 
+                      Py_ssize_t start, 
+                      Py_ssize_t end, 
+                      Py_ssize_t w, 
+                      real_t* lut) noexcept nogil:
+    # Write lut[c, value] in `dest` for each value of channel c of the rows. 
+    # `lut` is a contiguous (n, 65536) array.
+    cdef Py_ssize_t c, i, j
+    cdef Py_ssize_t s2 = strides[2]
+    cdef Py_ssize_t d2 = dest_strides[2]
+    cdef char* row
+    cdef char* dest_row
+    
+    for c in range(n):
+        for i in range(start, end):
+            row = <char*>data + c * strides[0] + i * strides[1]
+            dest_row = <char*>dest + c * dest_strides[0] + i * dest_strides[1]
+            for j in range(w):
+                (<real_t*>(dest_row + j * d2))[0] = lut[
+                    c * 65536 + <int>double_boxit_fast(
+                        (<real_t*>(row + j * s2))[0], 0., 65535.)]
+
+
+def channel_maxima(numpy.ndarray[real_t, ndim=3] pixels, threads=None):
+    """
+    Return the maximum of each channel of `pixels` as an array of doubles. Each
+    of `threads` threads (default: see `get_num_bands`) finds the maxima of a 
+    band of rows, which are then merged.
+    """
+    cdef Py_ssize_t b
+    cdef Py_ssize_t n = pixels.shape[0]
+    cdef Py_ssize_t h = pixels.shape[1]
+    cdef Py_ssize_t w = pixels.shape[2]
+    cdef Py_ssize_t num_bands = get_num_bands(threads, h)
+    cdef int num_threads = num_bands
+    cdef real_t* data = <real_t*>pixels.data
+    cdef Py_ssize_t* strides = <Py_ssize_t*>pixels.strides
+    cdef numpy.ndarray[numpy.double_t, ndim=2] band_maxima
+    cdef double* maxima
+    
+    band_maxima = numpy.empty(shape=(num_bands, n), dtype=numpy.double)
+    band_maxima.fill(-numpy.inf)
+    maxima = <double*>band_maxima.data
+    for b in prange(num_bands, nogil=True, num_threads=num_threads, 
+                    schedule='static'):
+        max_rows(data, strides, n, 
+                 band_start(b, num_bands, h), band_start(b + 1, num_bands, h), 
+                 w, maxima + b * n)
+    return(band_maxima.max(axis=0))
+
+
+def channel_histograms(numpy.ndarray[real_t, ndim=3] pixels, 
+                       hists=None, 
+                       threads=None):
+    """
+    Integer histogram of each channel of `pixels`, one bin per 16 bit value 
+    (i.e. a bincount over the uint16 version of the data, without making the 
+    uint16 copy). Values are clipped to [0, 65535].
+    
+    If `hists` is given, it has to have shape (n_channels, 65536) and counts are 
+    added to it.
+    
+    Each of `threads` threads (default: see `get_num_bands`) counts a band of 
+    rows in its own histograms, which are then added up.
+    """
+    cdef Py_ssize_t b
+    cdef Py_ssize_t n = pixels.shape[0]
+    cdef Py_ssize_t h = pixels.shape[1]
+    cdef Py_ssize_t w = pixels.shape[2]
+    cdef Py_ssize_t num_bands = get_num_bands(threads, h)
+    cdef int num_threads = num_bands
+    cdef real_t* data = <real_t*>pixels.data
+    cdef Py_ssize_t* strides = <Py_ssize_t*>pixels.strides
+    cdef numpy.ndarray[numpy.int32_t, ndim=3] counts
+    cdef numpy.int32_t* band_counts
+    
+    if(hists is None):
+        hists = numpy.zeros(shape=(n, 65536), dtype=numpy.int64)
+    counts = numpy.zeros(shape=(num_bands, n, 65536), dtype=numpy.int32)
+    band_counts = <numpy.int32_t*>counts.data
+    
+    for b in prange(num_bands, nogil=True, num_threads=num_threads, 
+                    schedule='static'):
+        count_rows(data, strides, n, 
+                   band_start(b, num_bands, h), band_start(b + 1, num_bands, h), 
+                   w, band_counts + b * n * 65536)
+    hists += counts.sum(axis=0, dtype=numpy.int64)
+    return(hists)
+
+
+def scale_channels(numpy.ndarray[real_t, ndim=3] pixels, 
+                   double factor, 
+                   hists=None, 
+                   wb_mult=None, 
+                   threads=None):
+    """
+    Multiply `pixels` by `factor` in place, after multiplying each channel by 
+    its coefficient in `wb_mult` if given. If `hists` is given, also count the 
+    scaled values in it (see `channel_histograms`) in the same pass.
+    
+    Each of `threads` threads (default: see `get_num_bands`) works on a band 
+    of rows.
+    """
+    cdef Py_ssize_t b
+    cdef Py_ssize_t n = pixels.shape[0]
+    cdef Py_ssize_t h = pixels.shape[1]
+    cdef Py_ssize_t w = pixels.shape[2]
+    cdef Py_ssize_t num_bands = get_num_bands(threads, h)
+    cdef int num_threads = num_bands
+    cdef real_t* data = <real_t*>pixels.data
+    cdef Py_ssize_t* strides = <Py_ssize_t*>pixels.strides
+    cdef numpy.ndarray[numpy.double_t, ndim=1] mult
+    cdef numpy.ndarray[numpy.int32_t, ndim=3] counts
+    cdef numpy.int32_t* band_counts = NULL
+    
+    mult = numpy.ones(shape=(n, ), dtype=numpy.double)
+    if(wb_mult is not None):
+        mult[:] = wb_mult
+    if(hists is not None):
+        counts = numpy.zeros(shape=(num_bands, n, 65536), dtype=numpy.int32)
+        band_counts = <numpy.int32_t*>counts.data
+    
+    for b in prange(num_bands, nogil=True, num_threads=num_threads, 
+                    schedule='static'):
+        scale_rows(data, strides, n, 
+                   band_start(b, num_bands, h), band_start(b + 1, num_bands, h), 
+                   w, <double*>mult.data, factor, 
+                   NULL if band_counts == NULL else band_counts + b * n * 65536)
+    if(hists is not None):
+        hists += counts.sum(axis=0, dtype=numpy.int64)
     return(pixels)
 
 
-def histogram_equalize(numpy.ndarray[numpy.double_t, ndim=3] pixels):
+def histogram_equalize(numpy.ndarray[real_t, ndim=3] pixels, 
+                       hists=None, 
+                       out=None, 
+                       threads=None):
     """
     Histogram equalization, color by color. See
         http://www.janeriksolem.net/2009/06/histogram-equalization-with-python-and.html
+    
+    Pixel values are assumed to be in [0, 65535]. The per channel histograms 
+    are integer counts over 65536 bins: if they have already been computed 
+    (e.g. by `demosaic` while scaling) they can be passed in as `hists`. Their 
+    normalized cumulative sum is used as a lookup table applied to each pixel,
+    by `threads` threads (default: see `get_num_bands`) each working on a band 
+    of rows.
+    
+    The result is written in `out` if given (an array of the same shape and 
+    type as `pixels`), otherwise `pixels` is modified in place. Raise 
+    ValueError if `out` or `hists` do not fit `pixels`.
     """
-    cdef int i
-    cdef tuple shp = (pixels.shape[0], pixels.shape[1], pixels.shape[2])
-    cdef numpy.ndarray[numpy.double_t, ndim=2] out = numpy.zeros(shape=(shp[0], shp[1]*shp[2]),
-                                                                 dtype=numpy.double)
-    cdef numpy.ndarray[numpy.double_t, ndim=1] flat = numpy.zeros(shape=(shp[1]*shp[2], ),
-                                                                  dtype=numpy.double)
+    cdef Py_ssize_t b
+    cdef Py_ssize_t n = pixels.shape[0]
+    cdef Py_ssize_t h = pixels.shape[1]
+    cdef Py_ssize_t w = pixels.shape[2]
+    cdef Py_ssize_t num_bands = get_num_bands(threads, h)
+    cdef int num_threads = num_bands
+    cdef numpy.ndarray[real_t, ndim=2] lut
+    cdef numpy.ndarray[real_t, ndim=3] dest
     
+    # The kernels below do not check their bounds: we do it here.
+    if(hists is None):
+        hists = channel_histograms(pixels, None, threads)
+    hists = numpy.asarray(hists)
+    if(hists.ndim != 2 or hists.shape[0] < n or hists.shape[1] != 65536):
+        raise(ValueError('hists must be a (%d, 65536) array.' % (n)))
+    if(out is None):
+        out = pixels
+    elif(out.shape != (n, h, w)):
+        raise(ValueError('out must be a (%d, %d, %d) array.' % (n, h, w)))
+    dest = out
     
-    for i in range(3):
-        flat = pixels[i].flatten()
-        
-        hist, bins = numpy.histogram(flat, 65535, normed=True)
-        cdf = hist.cumsum()
-        cdf = 65535 * cdf / cdf[-1]
-        out[i] = numpy.interp(flat, bins[:-1], cdf)
-    return(out.reshape(shp))
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    # The CDF of each channel, normalized to [0, 65535]: it is our LUT.
+    cdf = numpy.cumsum(hists, axis=1, dtype=numpy.double)
+    cdf *= 65535. / numpy.maximum(cdf[:, -1:], 1.)
+    lut = numpy.ascontiguousarray(cdf, dtype=pixels.dtype)
+    
+    cdef real_t* data = <real_t*>pixels.data
+    cdef Py_ssize_t* strides = <Py_ssize_t*>pixels.strides
+    cdef real_t* dest_data = <real_t*>dest.data
+    cdef Py_ssize_t* dest_strides = <Py_ssize_t*>dest.strides
+    cdef real_t* lut_data = <real_t*>lut.data
+    for b in prange(num_bands, nogil=True, num_threads=num_threads, 
+                    schedule='static'):
+        lookup_rows(data, strides, dest_data, dest_strides, n, 
+                    band_start(b, num_bands, h), band_start(b + 1, num_bands, h),
+                    w, lut_data)
+    return(out)
@@ -0,0 +1,188 @@
+"""
+Prefetching file reader
+
+Read a list of files on a background thread, a few files ahead of whoever is
+consuming them, so that I/O and decoding overlap:
+
+    for (file_name, data, error) in Prefetcher(file_names, depth=2):
+        if(error is None):
+            decode_nef(data)
+            data.close()
+
+Each file is read in full into an anonymous memory map (or simply memory
+mapped, see Prefetcher) which can be used like a read-only file and by numpy
+without copies. At most `depth` files wait in the queue, so memory use is
+bounded by depth + 2 files (the queued ones, the one being read and the one
+being consumed).
+
+Where the OS supports it, the kernel is also asked to start reading the next
+file (posix_fadvise WILLNEED) while the current one is being read.
+"""
+import mmap
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+
+# Constants
+DEPTH = 2
+CHUNK_SIZE = 1 << 20
+# How long (in seconds) the reader thread waits on a full queue before checking
+# whether it has been stopped.
+POLL_INTERVAL = .1
+# End of the queue marker.
+DONE = None
+
+
+
+
+def advise(file_name):
+    """
+    Tell the kernel that we are going to read `file_name` soon, if the OS lets
+    us. Return True if the hint was given.
+    """
+    if(not hasattr(os, 'posix_fadvise')):
+        return(False)
+    try:
+        fd = os.open(file_name, os.O_RDONLY)
+    except OSError:
+        return(False)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        return(False)
+    finally:
+        os.close(fd)
+    return(True)
+
+
+def read_file(file_name, use_mmap=False):
+    """
+    Return the content of `file_name` as a mmap object. If `use_mmap` is True
+    the file itself is mapped and all its pages touched once (so that they are
+    in the page cache), otherwise it is read into an anonymous map.
+    """
+    f = open(file_name, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if(hasattr(os, 'posix_fadvise')):
+            # Only a hint: the file can be read anyway.
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+
+        if(use_mmap):
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for position in range(0, size, mmap.PAGESIZE):
+                data[position]
+            return(data)
+
+        data = mmap.mmap(-1, max(1, size))
+        while(True):
+            chunk = f.read(CHUNK_SIZE)
+            if(not chunk):
+                break
+            data.write(chunk)
+        data.seek(0, os.SEEK_SET)
+        return(data)
+    finally:
+        f.close()
+
+
+def read_files(file_names, use_mmap=False):
+    """
+    Same as Prefetcher, but without reading ahead: each file is read when the
+    consumer asks for it.
+    """
+    for file_name in file_names:
+        data = None
+        error = None
+        try:
+            data = read_file(file_name, use_mmap)
+        except Exception as e:
+            error = e
+        yield(file_name, data, error)
+
+
+class Prefetcher(object):
+    """
+    Iterate over (file_name, data, error) for each of `file_names`, in order,
+    reading up to `depth` files ahead on a background thread. `data` is the
+    content of the file (see read_file), or None if it could not be read, in
+    which case `error` is the exception raised while reading it.
+
+    The consumer owns `data` and should close it when done. Call close (or use
+    the Prefetcher as a context manager) to stop reading ahead if not all the
+    files are consumed.
+    """
+    def __init__(self, file_names, depth=DEPTH, use_mmap=False):
+        self.file_names = list(file_names)
+        self.depth = max(1, depth)
+        self.use_mmap = use_mmap
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return(False)
+
+    def put(self, item):
+        # Wait for a free slot in the queue. Return False if we were stopped in
+        # the meantime.
+        while(not self.stopped.is_set()):
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return(True)
+            except queue.Full:
+                pass
+        return(False)
+
+    def run(self):
+        # The reader thread.
+        for i, file_name in enumerate(self.file_names):
+            if(i + 1 < len(self.file_names)):
+                advise(self.file_names[i + 1])
+            data = None
+            error = None
+            try:
+                data = read_file(file_name, self.use_mmap)
+            except Exception as e:
+                error = e
+            if(not self.put((file_name, data, error))):
+                if(data is not None):
+                    data.close()
+                return
+        self.put(DONE)
+
+    def __iter__(self):
+        while(True):
+            item = self.queue.get()
+            if(item is DONE):
+                return
+            yield(item)
+
+    def close(self):
+        """
+        Stop the reader thread and release the files it had read ahead.
+        """
+        self.stopped.set()
+        while(self.thread.is_alive() or not self.queue.empty()):
+            try:
+                item = self.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if(item is not DONE and item[1] is not None):
+                item[1].close()
+        self.thread.join()
@@ -0,0 +1,224 @@
+"""
+Deep Zoom tile pyramids
+
+Turn a demosaiced (3, h, w) raster (e.g. the output of decode_file) into a Deep
+Zoom Image (DZI) pyramid for web viewers: a name.dzi XML descriptor and a
+name_files directory with one sub-directory per zoom level, each holding the
+tile_size x tile_size tiles of that level as <column>_<row>.<format>.
+
+Level N (the highest) is the full resolution image, level N-1 is half its size
+(each pixel being the average of a 2x2 block of level N) and so on down to
+level 0, which is a single pixel.
+
+The raster is processed one band of tile_size rows at a time: each band is cut
+into tiles and then reduced and passed on to the level below, which in turn
+cuts its tiles once it has accumulated enough rows. No level is ever held in
+memory as a whole. Tiles are encoded and written by a pool of threads.
+"""
+import math
+import os
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from PIL import Image
+
+
+
+# Constants
+TILE_SIZE = 256
+TILE_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG'}
+DZI_FMT = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+       Format="%s"
+       Overlap="0"
+       TileSize="%d">
+  <Size Width="%d" Height="%d"/>
+</Image>
+'''
+# Maximum number of tiles waiting to be written, per thread.
+MAX_PENDING_TILES = 8
+
+
+
+
+def reduce_band(band):
+    """
+    Halve the size of the (rows, cols, 3) float `band` by averaging each 2x2
+    block of pixels. Odd sizes are handled by repeating the last row/column.
+    """
+    if(band.shape[0] % 2):
+        band = numpy.concatenate((band, band[-1:]), axis=0)
+    if(band.shape[1] % 2):
+        band = numpy.concatenate((band, band[:, -1:]), axis=1)
+    return(.25 * (band[0::2, 0::2] + band[0::2, 1::2] +
+                  band[1::2, 0::2] + band[1::2, 1::2]))
+
+
+def write_tile(tile, file_name, fmt):
+    """
+    Write the (rows, cols, 3) uint8 `tile` to `file_name` in the PIL format
+    `fmt`.
+    """
+    Image.fromarray(tile, 'RGB').save(file_name, fmt)
+    return(file_name)
+
+
+class PyramidWriter(object):
+    """
+    Build a DZI pyramid one band of rows at a time: see push_band. Call close
+    once the whole image has been pushed, or abort if something went wrong. As
+    a context manager, it does one or the other on exit:
+
+        with PyramidWriter('foo.dzi', w, h) as writer:
+            for band in bands:
+                writer.push_band(band)
+    """
+    def __init__(self, file_name, width, height, tile_format='png',
+                 tile_size=TILE_SIZE, threads=None):
+        """
+        `file_name` is the name of the .dzi descriptor of the `width` x
+        `height` image. Tiles go in the file_name_files directory (without the
+        .dzi extension) and are in `tile_format` (see TILE_FORMATS). They are
+        written by `threads` threads (default: one per CPU).
+        """
+        base, ext = os.path.splitext(file_name)
+        if(ext.lower() != '.dzi'):
+            base = file_name
+        tile_format = tile_format.lower()
+        if(tile_format not in TILE_FORMATS):
+            raise(NotImplementedError('Unsupported tile format %s.' \
+                                      % (tile_format)))
+        self.file_name = base + '.dzi'
+        self.tiles_dir = base + '_files'
+        self.tile_ext = tile_format
+        self.tile_fmt = TILE_FORMATS[tile_format]
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+
+        # Level num_levels-1 is the full resolution one, level 0 is 1x1.
+        self.num_levels = int(math.ceil(math.log(max(width, height), 2))) + 1
+
+        # Rows waiting to be cut into tiles and the next tile row, per level.
+        self.pending = [None, ] * self.num_levels
+        self.tile_rows = [0, ] * self.num_levels
+
+        if(not threads):
+            threads = cpu_count()
+        self.pool = ThreadPool(threads)
+        self.max_pending = MAX_PENDING_TILES * threads
+        self.results = []
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if(exc_type is None):
+            self.close()
+        else:
+            self.abort()
+        return(False)
+
+    def level_dir(self, i):
+        # Directory of the i-th level from the top (0 = full resolution).
+        return(os.path.join(self.tiles_dir, str(self.num_levels - 1 - i)))
+
+    def push_band(self, band):
+        """
+        Add the next `band` of rows of the full resolution image. `band` is a
+        (3, rows, width) array of values in [0, 65535], like the output of
+        decode_file. All bands but the last one need to have an even number of
+        rows (a multiple of tile_size is best).
+        """
+        band = numpy.asarray(band, dtype=numpy.float32).transpose(1, 2, 0)
+        self.push(0, band)
+
+    def push(self, i, band):
+        # Add the (rows, cols, 3) `band` to level i from the top and emit all
+        # the full rows of tiles we have.
+        if(self.pending[i] is not None):
+            band = numpy.concatenate((self.pending[i], band), axis=0)
+        while(band.shape[0] >= self.tile_size):
+            self.emit(i, band[:self.tile_size])
+            band = band[self.tile_size:]
+        self.pending[i] = band
+
+    def emit(self, i, band):
+        # Cut `band` into one row of tiles of level i, write them and pass the
+        # reduced band on to level i+1.
+        if(not band.shape[0]):
+            return
+
+        level_dir = self.level_dir(i)
+        if(not os.path.isdir(level_dir)):
+            os.makedirs(level_dir)
+        data = numpy.clip(band / 257., 0., 255.).round().astype(numpy.uint8)
+        for col in range(0, band.shape[1], self.tile_size):
+            name = os.path.join(level_dir, '%d_%d.%s' % (col // self.tile_size,
+                                                         self.tile_rows[i],
+                                                         self.tile_ext))
+            tile = numpy.ascontiguousarray(data[:, col:col+self.tile_size])
+            self.results.append(self.pool.apply_async(write_tile,
+                                                      (tile, name,
+                                                       self.tile_fmt)))
+        self.tile_rows[i] += 1
+
+        # Do not let tiles pile up in memory if writing is slow.
+        while(len(self.results) > self.max_pending):
+            self.results.pop(0).get()
+
+        if(i + 1 < self.num_levels):
+            self.push(i + 1, reduce_band(band))
+
+    def close(self):
+        """
+        Flush the last rows of each level, wait for all tiles to be written and
+        write the .dzi descriptor. If writing a tile fails, the pool is
+        terminated (see abort) and the error raised.
+        """
+        try:
+            for i in range(self.num_levels):
+                band = self.pending[i]
+                self.pending[i] = None
+                if(band is not None):
+                    self.emit(i, band)
+            self.pool.close()
+            self.pool.join()
+            for result in self.results:
+                result.get()
+        except:
+            self.abort()
+            raise
+        self.results = []
+
+        f = open(self.file_name, 'w')
+        f.write(DZI_FMT % (self.tile_ext, self.tile_size, self.width,
+                           self.height))
+        f.close()
+
+    def abort(self):
+        """
+        Stop the writing threads, dropping the tiles not written yet. No .dzi
+        descriptor is written.
+        """
+        self.pool.terminate()
+        self.pool.join()
+        self.pending = [None, ] * self.num_levels
+        self.results = []
+
+
+def write_pyramid(pixels, file_name, tile_format='png', tile_size=TILE_SIZE,
+                  threads=None):
+    """
+    Write the (3, h, w) demosaiced raster `pixels` (values in [0, 65535]) as a
+    DZI pyramid with descriptor `file_name` (see PyramidWriter). Return the
+    name of the descriptor.
+    """
+    height = pixels.shape[1]
+    with PyramidWriter(file_name, pixels.shape[2], height, tile_format,
+                       tile_size, threads) as writer:
+        for row in range(0, height, tile_size):
+            writer.push_band(pixels[:, row:row+tile_size])
+    return(writer.file_name)
@@ -0,0 +1,251 @@
+"""
+Raw archives
+
+A compact, lossless container for decoded CFA mosaics (e.g. NEFFile.raw), so
+that images can be reprocessed without decoding the NEF again. The layout is
+
+    8 bytes     MAGIC
+    4 bytes     length n of the header (little-endian uint32)
+    n bytes     JSON header (see write_archive)
+    8 * (c + 1) bytes   offsets of the c chunks from the start of the file, plus
+                the end of the last one (little-endian uint64)
+    ...         the chunks
+
+The mosaic is stored as little-endian uint16 in chunks of `rows_per_chunk`
+rows, each compressed with zlib. Before compression, each pixel but the first
+two of a row is replaced by its difference (modulo 2^16) with the pixel two
+columns to its left, i.e. the previous pixel of the same color: neighbouring
+values are close and the differences compress much better than the values.
+
+Archives are memory mapped when opened and only the chunks covering the rows
+that are asked for are decompressed (see RawArchive.read_rows).
+"""
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy
+
+import pixelutils
+
+
+
+# Constants
+MAGIC = b'NEFRAW01'
+ROWS_PER_CHUNK = 64
+LEVEL = 6
+FILTER = 'delta2'
+MOSAIC_DTYPE = numpy.dtype('<u2')
+
+
+
+
+def encode_rows(rows, filter=FILTER):
+    """
+    Return the (h, w) uint16 `rows` filtered (see the module docs) and
+    serialized as little-endian bytes.
+    """
+    rows = numpy.asarray(rows, dtype=MOSAIC_DTYPE)
+    if(filter == FILTER):
+        out = rows.copy()
+        out[:, 2:] -= rows[:, :-2]
+        rows = out
+    return(rows.tobytes())
+
+
+def decode_rows(buffer, width, filter=FILTER):
+    """
+    The reverse of encode_rows: return the (h, width) uint16 array serialized
+    in `buffer`.
+    """
+    rows = numpy.frombuffer(buffer, dtype=MOSAIC_DTYPE).reshape(-1, width)
+    if(filter == FILTER):
+        # Running sums of each color in uint16 undo the wrapped differences.
+        out = numpy.empty(shape=rows.shape, dtype=numpy.uint16)
+        numpy.cumsum(rows[:, 0::2], axis=1, dtype=numpy.uint16,
+                     out=out[:, 0::2])
+        numpy.cumsum(rows[:, 1::2], axis=1, dtype=numpy.uint16,
+                     out=out[:, 1::2])
+        return(out)
+    return(rows.astype(numpy.uint16))
+
+
+def write_archive(file_name, mosaic, cfa_pattern, curve=None,
+                  curve_max_len=None, wb=None, tags=None,
+                  rows_per_chunk=ROWS_PER_CHUNK, level=LEVEL):
+    """
+    Write the (h, w) uint16 CFA `mosaic` to the raw archive `file_name`.
+
+    The JSON header records the size of the mosaic, its `cfa_pattern` (see
+    pixelutils.CFA_PHASES), the linearization `curve` and `curve_max_len` (see
+    nef_decoder.get_linearization), the white balance coefficients `wb` and
+    `tags`, a list of [role, tag_id, tag_name, value] (see NEFFile.export).
+    Tags whose value cannot be stored as JSON are skipped.
+
+    Chunks of `rows_per_chunk` rows are compressed with zlib at `level`.
+    """
+    mosaic = numpy.asarray(mosaic)
+    if(mosaic.ndim != 2 or mosaic.dtype != numpy.uint16):
+        raise(ValueError('The mosaic must be a 2D uint16 array.'))
+    (height, width) = mosaic.shape
+
+    stored_tags = []
+    for tag in (tags or []):
+        try:
+            json.dumps(tag)
+        except (TypeError, ValueError):
+            continue
+        stored_tags.append(list(tag))
+
+    header = {'width': width,
+              'height': height,
+              'rows_per_chunk': rows_per_chunk,
+              'filter': FILTER,
+              'cfa_pattern': list(cfa_pattern),
+              'curve': None,
+              'curve_max_len': curve_max_len,
+              'wb': None,
+              'tags': stored_tags}
+    if(curve is not None):
+        header['curve'] = numpy.asarray(curve).tolist()
+    if(wb is not None):
+        header['wb'] = [float(x) for x in wb]
+    header = json.dumps(header).encode('utf-8')
+
+    num_chunks = (height + rows_per_chunk - 1) // rows_per_chunk
+    offsets = numpy.zeros(shape=(num_chunks + 1, ), dtype='<u8')
+    table_offset = len(MAGIC) + 4 + len(header)
+
+    f = open(file_name, 'wb')
+    f.write(MAGIC)
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    f.write(offsets.tobytes())
+    offsets[0] = table_offset + offsets.nbytes
+    for i in range(num_chunks):
+        rows = mosaic[i * rows_per_chunk:(i + 1) * rows_per_chunk]
+        chunk = zlib.compress(encode_rows(rows), level)
+        f.write(chunk)
+        offsets[i + 1] = offsets[i] + len(chunk)
+
+    # Now that we know where the chunks are, fill in the table.
+    f.seek(table_offset, os.SEEK_SET)
+    f.write(offsets.tobytes())
+    f.close()
+    return(file_name)
+
+
+class RawArchive(object):
+    """
+    A raw archive (see write_archive), opened for reading:
+
+        with RawArchive('foo.nefraw') as archive:
+            archive.read_rows(100, 200)     # rows 100 to 199 of the mosaic
+            archive.raw                     # the whole mosaic
+            archive.rgb()                   # demosaiced image
+
+    The header fields are available as attributes (width, height, cfa_pattern,
+    curve, curve_max_len, wb) and the tags as a dictionary keyed by tag_id or,
+    for tags stored with a role, (role, tag_id), like NEFFile.tags.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if(self.data[:len(MAGIC)] != MAGIC):
+            self.close()
+            raise(Exception('%s is not a raw archive.' % (file_name)))
+
+        start = len(MAGIC) + 4
+        header_len = struct.unpack('<I', self.data[len(MAGIC):start])[0]
+        self.header = json.loads(self.data[start:start + header_len]
+                                 .decode('utf-8'))
+        self.width = self.header['width']
+        self.height = self.header['height']
+        self.rows_per_chunk = self.header['rows_per_chunk']
+        self.filter = self.header['filter']
+        self.cfa_pattern = tuple(self.header['cfa_pattern'])
+        self.curve = self.header['curve']
+        self.curve_max_len = self.header['curve_max_len']
+        self.wb = self.header['wb']
+        if(self.wb is not None):
+            self.wb = tuple(self.wb)
+        self.tags = {}
+        for (role, tag_id, tag_name, value) in self.header['tags']:
+            entry = [None, tag_name, None, None, value]
+            if(role is None):
+                self.tags[tag_id] = entry
+            else:
+                self.tags[(role, tag_id)] = entry
+
+        num_chunks = (self.height + self.rows_per_chunk - 1) // \
+                     self.rows_per_chunk
+        self.offsets = numpy.frombuffer(self.data, dtype='<u8',
+                                        count=num_chunks + 1,
+                                        offset=start + header_len)
+        self.offsets = self.offsets.astype(numpy.int64)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return(False)
+
+    def close(self):
+        """
+        Release the memory map and the file.
+        """
+        self.offsets = None
+        if(self.data is not None):
+            self.data.close()
+            self.data = None
+        if(self.file is not None):
+            self.file.close()
+            self.file = None
+
+    def read_rows(self, y0=0, y1=None):
+        """
+        Return rows `y0` to `y1` (excluded, default: the last row) of the mosaic
+        as a (y1 - y0, width) uint16 array. Only the chunks holding those rows
+        are decompressed.
+        """
+        if(y1 is None):
+            y1 = self.height
+        y0 = max(0, y0)
+        y1 = min(self.height, y1)
+        out = numpy.empty(shape=(max(0, y1 - y0), self.width),
+                          dtype=numpy.uint16)
+        if(y1 <= y0):
+            return(out)
+
+        for i in range(y0 // self.rows_per_chunk,
+                       (y1 - 1) // self.rows_per_chunk + 1):
+            chunk_y0 = i * self.rows_per_chunk
+            buffer = zlib.decompress(self.data[self.offsets[i]:
+                                               self.offsets[i + 1]])
+            rows = decode_rows(buffer, self.width, self.filter)
+            a = max(y0, chunk_y0)
+            b = min(y1, chunk_y0 + rows.shape[0])
+            out[a - y0:b - y0] = rows[a - chunk_y0:b - chunk_y0]
+        return(out)
+
+    @property
+    def raw(self):
+        """
+        The whole CFA mosaic.
+        """
+        return(self.read_rows())
+
+    def rgb(self, wb=None, scale=True, equalize=False, dtype=numpy.double):
+        """
+        The demosaiced (3, h, w) image of type `dtype`, white balanced with the
+        `wb` coefficients (default: the ones in the archive, if any) and
+        optionally scaled and equalized (see pixelutils.demosaic).
+        """
+        if(wb is None):
+            wb = self.wb or (1., 1., 1.)
+        return(pixelutils.demosaic(self.raw, self.cfa_pattern, scale, equalize,
+                                   tuple(wb), dtype=dtype))
@@ -1,16 +1,62 @@
+"""
+Build the pixelutils extension in place:
+
+    python setup.py build_ext --inplace
+
+The PIXELUTILS_BUILD environment variable selects the variant:
+    release     (default) no bounds checking nor negative index wrapping, -O3.
+    profile     profiling and line tracing hooks (so that cProfile, e.g.
+                nef_decoder.py -p, sees inside the kernels) and bounds
+                checking on. Much slower: only use it to find hot spots.
+
+The post-demosaic kernels run on several threads with OpenMP. Set
+PIXELUTILS_OPENMP=0 to build without it (e.g. if the compiler does not support
+-fopenmp): they then run on a single thread.
+"""
+import os
+
 from distutils.core import setup
 from distutils.extension import Extension
-from Cython.Distutils import build_ext
+from Cython.Build import cythonize
 
 import numpy
 
 
-ext_modules = [Extension("pixelutils", 
+BUILDS = {'release': {'directives': {'boundscheck': False,
+                                     'wraparound': False,
+                                     'profile': False},
+                      'macros': [],
+                      'cflags': ['-O3']},
+          'profile': {'directives': {'boundscheck': True,
+                                     'wraparound': True,
+                                     'profile': True,
+                                     'linetrace': True},
+                      'macros': [('CYTHON_TRACE', '1'),
+                                 ('CYTHON_TRACE_NOGIL', '1')],
+                      'cflags': ['-O1']}}
+
+build = os.environ.get('PIXELUTILS_BUILD', 'release')
+if(build not in BUILDS):
+    raise(ValueError('Unknown PIXELUTILS_BUILD %s (choose from %s).' \
+                     % (build, ', '.join(sorted(BUILDS)))))
+directives = dict(BUILDS[build]['directives'], language_level=2)
+
+cflags = list(BUILDS[build]['cflags'])
+ldflags = []
+if(os.environ.get('PIXELUTILS_OPENMP', '1') != '0'):
+    cflags.append('-fopenmp')
+    ldflags.append('-fopenmp')
+
+ext_modules = [Extension("pixelutils",
                          ["pixelutils.pyx"],
-                         include_dirs=[numpy.get_include()]), ]
+                         include_dirs=[numpy.get_include()],
+                         define_macros=BUILDS[build]['macros'],
+                         extra_compile_args=cflags,
+                         extra_link_args=ldflags), ]
 
 setup(
   name = 'Pixel Utilities',
-  cmdclass = {'build_ext': build_ext},
-  ext_modules = ext_modules
+  ext_modules = cythonize(ext_modules,
+                          compiler_directives=directives,
+                          force=True)
 )
@@ -0,0 +1,487 @@
+"""
+End to end checks of nef_decoder on synthetic NEFs. Run with
+
+    python test_nef_decoder.py
+
+after building pixelutils (see setup.py).
+"""
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy
+
+import nef_decoder
+import pixelutils
+import rawarchive
+from bench_pixelutils import encode_deltas
+
+
+
+
+WIDTH = 36
+HEIGHT = 24
+VERT_PREDS = (100, 100, 100, 100)
+CFA_PATTERN = (2, 1, 1, 0)
+# (x, y, w, h): inside, at the corners, odd sizes and offsets, the whole image.
+ROIS = ((10, 7, 20, 16), (0, 0, 5, 5), (5, 7, 10, 9), (1, 1, 34, 22),
+        (20, 10, 16, 14), (31, 19, 5, 5), (0, 0, WIDTH, HEIGHT))
+WB_MULT = (2., 1., 1.5)
+# Largest difference between float32 and float64 images, relative to the
+# largest value (float32 has a 24 bit mantissa).
+FLOAT32_TOLERANCE = 1e-6
+# A linearization curve that ends in a plateau from code SATURATION_CODE on.
+SATURATION_CODE = 3000
+PLATEAU_CURVE = [2 * min(i, SATURATION_CODE) + 1 for i in range(1 << 12)]
+
+
+def make_ifd(entries, offset, next_offset=0):
+    """
+    Serialize the IFD `entries`, a list of (tag_id, type_id, count, value)
+    where value is the big-endian encoded value, to be written at `offset`.
+    Values longer than 4 bytes are written right after the entry table.
+    """
+    table = struct.pack('>H', len(entries))
+    extra = b''
+    extra_offset = offset + 2 + 12 * len(entries) + 4
+    for (tag_id, type_id, count, value) in sorted(entries):
+        if(len(value) > 4):
+            table += struct.pack('>HHII', tag_id, type_id, count,
+                                 extra_offset + len(extra))
+            extra += value
+        else:
+            table += struct.pack('>HHI', tag_id, type_id, count)
+            table += value + b'\0' * (4 - len(value))
+    return(table + struct.pack('>I', next_offset) + extra)
+
+
+def make_nef(mosaic, cfa_pattern=CFA_PATTERN, curve=None):
+    """
+    Return the bytes of a 12 bit, lossy compressed NEF with the (h, w) raw codes
+    `mosaic`, the `cfa_pattern` and the linearization `curve` (default: 2 * code)
+    and the (h, w) mosaic that decoding it should give.
+    """
+    (height, width) = mosaic.shape
+    if(curve is None):
+        curve = [2 * i for i in range(1 << 12)]
+
+    # Each pixel is predicted by the one two columns to its left or, in the
+    # first two columns, by the one two rows above it (VERT_PREDS at the top).
+    mosaic = mosaic.astype(numpy.int32)
+    above = numpy.empty(shape=(height, 2), dtype=numpy.int32)
+    above[:2] = numpy.array(VERT_PREDS).reshape(2, 2)
+    above[2:] = mosaic[:-2, :2]
+    deltas = mosaic.copy()
+    deltas[:, :2] -= above
+    deltas[:, 2:] -= mosaic[:, :-2]
+    data = encode_deltas(deltas, 0).tobytes()
+
+    # The Makernote: a TIFF of its own, with offsets relative to its header.
+    linearization = struct.pack('>BB4HH', 0x44, 0x10, *(VERT_PREDS +
+                                                        (len(curve), )))
+    linearization += struct.pack('>%dH' % (len(curve)), *curve)
+    makernote = b'Nikon\0' + struct.pack('>HH', 0x0210, 0) + b'MM' + \
+                struct.pack('>HI', 42, 8) + \
+                make_ifd([(nef_decoder.NEF_COMPRESSION_TAG_ID, 3, 1,
+                           struct.pack('>H', 1)),
+                          (nef_decoder.NIKON_LINCURVE_TAG_ID, 7,
+                           len(linearization), linearization)], 8)
+
+    # Header, pixel data, IFD0 (3 entries), raw IFD (14 entries), EXIF IFD.
+    data_offset = 8
+    ifd0_offset = data_offset + len(data) + len(data) % 2
+    raw_offset = ifd0_offset + 2 + 12 * 3 + 4
+    exif_offset = raw_offset + 2 + 12 * 14 + 4
+    ifd0 = make_ifd([(0xfe, 4, 1, struct.pack('>I', 1)),
+                     (330, 4, 1, struct.pack('>I', raw_offset)),
+                     (34665, 4, 1, struct.pack('>I', exif_offset))],
+                    ifd0_offset)
+    raw_ifd = make_ifd([(0xfe, 4, 1, struct.pack('>I', 0)),
+                        (256, 4, 1, struct.pack('>I', width)),
+                        (257, 4, 1, struct.pack('>I', height)),
+                        (258, 3, 1, struct.pack('>H', 12)),
+                        (259, 3, 1, struct.pack('>H', 34713)),
+                        (262, 3, 1, struct.pack('>H', 32803)),
+                        (273, 4, 1, struct.pack('>I', data_offset)),
+                        (277, 3, 1, struct.pack('>H', 1)),
+                        (278, 4, 1, struct.pack('>I', height)),
+                        (279, 4, 1, struct.pack('>I', len(data))),
+                        (284, 3, 1, struct.pack('>H', 1)),
+                        (0x828d, 3, 2, struct.pack('>HH', 2, 2)),
+                        (0x828e, 1, 4, struct.pack('>4B', *cfa_pattern)),
+                        (0x9217, 3, 1, struct.pack('>H', 2))], raw_offset)
+    exif_ifd = make_ifd([(271, 2, 4, b'ABC\0'),
+                         (nef_decoder.MAKERNOTE_TAG_ID, 7, len(makernote),
+                          makernote)], exif_offset)
+    nef = b'MM' + struct.pack('>HI', 42, ifd0_offset) + data + \
+          b'\0' * (len(data) % 2) + ifd0 + raw_ifd + exif_ifd
+
+    # The decoder never fills the last column.
+    expected = numpy.array(curve, dtype=numpy.uint16)[mosaic]
+    expected[:, -1] = 0
+    return(nef, expected)
+
+
+def random_mosaic(height=HEIGHT, width=WIDTH):
+    """
+    A random (height, width) mosaic of 12 bit codes.
+    """
+    return(numpy.random.randint(0, 1 << 12, size=(height, width)))
+
+
+def write_nef(dir_name, name, mosaic, cfa_pattern=CFA_PATTERN):
+    """
+    Write the NEF of `mosaic` (see make_nef) as `name` in `dir_name`. Return
+    its file name and the expected mosaic.
+    """
+    (nef, expected) = make_nef(mosaic, cfa_pattern)
+    file_name = os.path.join(dir_name, name)
+    f = open(file_name, 'wb')
+    f.write(nef)
+    f.close()
+    return(file_name, expected)
+
+
+def test_decode_files():
+    """
+    decode_files gives the same results as decode_file, with and without
+    prefetching, and reports the files it cannot decode.
+    """
+    dir_name = tempfile.mkdtemp()
+    try:
+        check_decode_files(dir_name)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def check_decode_files(dir_name):
+    file_names = []
+    expected = {}
+    for i in range(3):
+        (file_name, mosaic) = write_nef(dir_name, 'batch%d.nef' % (i),
+                                        random_mosaic())
+        file_names.append(file_name)
+        expected[file_name] = mosaic
+    bad_name = os.path.join(dir_name, 'bad.nef')
+    f = open(bad_name, 'wb')
+    f.write(b'II*\0' + b'\0' * 64)
+    f.close()
+    file_names.insert(1, bad_name)
+
+    for depth in (0, 2):
+        results = list(nef_decoder.decode_files(file_names, stats=True,
+                                                demosaic=False, depth=depth))
+        assert([r[0] for r in results] == file_names)
+        for (file_name, output, stats, error) in results:
+            if(file_name == bad_name):
+                assert(output is None and stats is None)
+                assert(error is not None)
+                continue
+            assert(error is None)
+            assert(numpy.array_equal(output[2], expected[file_name]))
+            assert(stats['count'].sum() == HEIGHT * (WIDTH - 1))
+
+        results = list(nef_decoder.decode_files(file_names[2:], depth=depth))
+        for (file_name, output, stats, error) in results:
+            assert(error is None and stats is None)
+            (ifds, makernote_ifd, rgb) = nef_decoder.decode_file(file_name)
+            assert(numpy.array_equal(output[2], rgb))
+
+
+def test_tags():
+    """
+    decode_nef returns the IFDs with their tag index, which gives the same
+    values as scanning the IFDs.
+    """
+    (nef, expected) = make_nef(random_mosaic())
+    data = mmap.mmap(-1, len(nef))
+    data.write(nef)
+    data.seek(0)
+    (ifds, makernote_ifd, mosaic) = nef_decoder.decode_nef(data,
+                                                           demosaic=False)
+    data.close()
+    assert(isinstance(ifds, nef_decoder.IFDList))
+    for tag_id in (271, 256, 257, nef_decoder.MAKERNOTE_TAG_ID):
+        assert(nef_decoder.get_tag_value(ifds, tag_id) ==
+               nef_decoder.get_tag_value(list(ifds), tag_id))
+    assert(nef_decoder.get_tag_value(ifds, 256,
+                                     role=nef_decoder.RAW_ROLE) == WIDTH)
+    assert(nef_decoder.get_tag_value(ifds, nef_decoder.NEF_COMPRESSION_TAG_ID,
+                                     role=nef_decoder.MAKERNOTE_ROLE) == 1)
+
+
+def test_roi():
+    """
+    The mosaic of a region of interest is the same crop of the whole mosaic,
+    for each CFA pattern. The demosaiced region is the same crop of the whole
+    interpolated image, scaled to its own maximum.
+    """
+    for cfa_pattern in sorted(pixelutils.CFA_PHASES):
+        (nef, expected) = make_nef(random_mosaic(), cfa_pattern)
+        data = mmap.mmap(-1, len(nef))
+        data.write(nef)
+        data.seek(0)
+        (ifds, makernote_ifd, full) = nef_decoder.decode_nef(data,
+                                                             demosaic=False)
+        assert(numpy.array_equal(full, expected))
+        planes = pixelutils.interpolate_mosaic(full, cfa_pattern)
+
+        for roi in ROIS:
+            (x, y, w, h) = roi
+            (x0, y0, x1, y1) = nef_decoder.get_roi_bounds(roi, WIDTH, HEIGHT)
+            data.seek(0)
+            mosaic = nef_decoder.decode_nef(data, roi=roi, demosaic=False)[2]
+            assert(numpy.array_equal(mosaic, full[y0:y1, x0:x1]))
+
+            data.seek(0)
+            rgb = nef_decoder.decode_nef(data, WB_MULT, roi=roi)[2]
+            crop = planes[:, y:y + h, x:x + w].copy()
+            assert(numpy.array_equal(rgb, pixelutils.balance_channels(
+                crop, True, False, WB_MULT)))
+        data.close()
+
+
+def test_roi_stats():
+    """
+    The raw statistics of a region of interest count the pixels of the
+    returned mosaic, and only those.
+    """
+    codes = random_mosaic()
+    (nef, expected) = make_nef(codes)
+    data = mmap.mmap(-1, len(nef))
+    data.write(nef)
+    for roi in ROIS:
+        (x0, y0, x1, y1) = nef_decoder.get_roi_bounds(roi, WIDTH, HEIGHT)
+        stats = {}
+        data.seek(0)
+        nef_decoder.decode_nef(data, roi=roi, stats=stats, demosaic=False)
+
+        # The last column of the image is never decoded.
+        x1 = min(x1, WIDTH - 1)
+        for k in range(4):
+            hist = numpy.bincount(codes[y0 + (k >> 1):y1:2,
+                                        x0 + (k & 1):x1:2].ravel(),
+                                  minlength=stats['hists'].shape[1])
+            assert(numpy.array_equal(stats['hists'][k], hist))
+    data.close()
+
+
+def percentile_value(values, percentile):
+    """
+    The smallest of `values` that at least `percentile` % of them do not exceed.
+    """
+    values = numpy.sort(values)
+    i = int(numpy.ceil(values.size * percentile / 100.)) - 1
+    return(values[max(0, i)])
+
+
+def test_raw_stats():
+    """
+    Every raw statistic matches what numpy gives on the known codes, with a
+    curve whose trailing plateau is trimmed from curve_max_len and pixels in
+    that plateau counted as clipped.
+    """
+    codes = random_mosaic(200, 160)
+    (nef, expected) = make_nef(codes, curve=PLATEAU_CURVE)
+    data = mmap.mmap(-1, len(nef))
+    data.write(nef)
+    data.seek(0)
+    stats = {}
+    nef_decoder.decode_nef(data, stats=stats, demosaic=False)
+    data.close()
+
+    curve = numpy.array(PLATEAU_CURVE)
+    assert(stats['saturation'] == curve[SATURATION_CODE])
+    assert(numpy.array_equal(stats['colors'], CFA_PATTERN))
+    for k in range(4):
+        # The last column of the image is never decoded.
+        position = codes[k >> 1::2, (k & 1):codes.shape[1] - 1:2].ravel()
+        values = curve[position]
+        assert(numpy.array_equal(stats['hists'][k][:1 << 12],
+                                 numpy.bincount(position, minlength=1 << 12)))
+        assert(stats['count'][k] == position.size)
+        assert(stats['min'][k] == values.min())
+        assert(stats['max'][k] == values.max())
+        assert(stats['clipped'][k] == (position >= SATURATION_CODE).sum())
+        assert(stats['clipped'][k] > 0)
+        assert(stats['black'][k] == percentile_value(
+            values, nef_decoder.BLACK_PERCENTILE))
+        assert(stats['white'][k] == percentile_value(
+            values, nef_decoder.WHITE_PERCENTILE))
+
+
+def test_demosaic_bands():
+    """
+    demosaic_bands gives exactly the same result as pixelutils.demosaic,
+    whatever the band size, and so does decoding with a tiny memory budget.
+    """
+    mosaic = numpy.random.randint(0, 8192, size=(40, 52)).astype(numpy.uint16)
+    for cfa_pattern in sorted(pixelutils.CFA_PHASES):
+        for dtype in (numpy.float32, numpy.double):
+            for (scale, equalize, wb_mult) in ((True, False, (1., 1., 1.)),
+                                               (True, False, WB_MULT),
+                                               (True, True, WB_MULT),
+                                               (False, False, WB_MULT),
+                                               (False, True, (1., 1., 1.))):
+                expected = pixelutils.demosaic(mosaic, cfa_pattern, scale,
+                                               equalize, wb_mult, dtype=dtype)
+                for band_rows in (2, 4, 6, 16, 38, 48):
+                    pixels = nef_decoder.demosaic_bands(mosaic, cfa_pattern,
+                                                        scale, equalize,
+                                                        wb_mult, dtype,
+                                                        band_rows)
+                    assert(pixels.dtype == expected.dtype)
+                    assert(numpy.array_equal(pixels, expected))
+                    del(pixels)
+
+    dir_name = tempfile.mkdtemp()
+    try:
+        (file_name, expected) = write_nef(dir_name, 'spill.nef',
+                                          random_mosaic())
+        (ifds, makernote_ifd, rgb) = nef_decoder.decode_file(file_name,
+                                                             WB_MULT)
+        output = nef_decoder.decode_file(file_name, WB_MULT, max_memory=1)
+        assert(isinstance(output[2], numpy.memmap))
+        assert(numpy.array_equal(output[2], rgb))
+        for depth in (0, 2):
+            for (name, output, stats, error) in nef_decoder.decode_files(
+                    [file_name, ], WB_MULT, depth=depth, max_memory=1):
+                assert(error is None)
+                assert(numpy.array_equal(output[2], rgb))
+            del(output)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+
+
+def test_dtype():
+    """
+    Decoding to float32 gives the float64 image within FLOAT32_TOLERANCE, and
+    types that are neither are refused before decoding.
+    """
+    dir_name = tempfile.mkdtemp()
+    try:
+        check_dtype(dir_name)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def check_dtype(dir_name):
+    (file_name, expected) = write_nef(dir_name, 'dtype.nef', random_mosaic())
+    rgb = nef_decoder.decode_file(file_name, WB_MULT)[2]
+    for dtype in (numpy.float32, 'float32', numpy.dtype(numpy.float32)):
+        output = nef_decoder.decode_file(file_name, WB_MULT, dtype=dtype)[2]
+        assert(output.dtype == numpy.float32)
+        assert(numpy.abs(output - rgb).max() <= FLOAT32_TOLERANCE * rgb.max())
+
+    for dtype in (numpy.uint16, numpy.int32, numpy.float16, 'foo'):
+        for decode in (lambda: nef_decoder.decode_file(file_name, dtype=dtype),
+                       lambda: nef_decoder.NEFFile(file_name, dtype=dtype)):
+            try:
+                decode()
+            except ValueError:
+                continue
+            raise(AssertionError('%s accepted.' % (str(dtype))))
+
+
+def test_nef_file():
+    """
+    NEFFile decodes the raw data once, gives the same results as decode_file,
+    keeps the last rendition and releases the file when closed.
+    """
+    dir_name = tempfile.mkdtemp()
+    try:
+        check_nef_file(dir_name)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def check_nef_file(dir_name):
+    (file_name, expected) = write_nef(dir_name, 'file.nef', random_mosaic())
+    stats = {}
+    mosaic = nef_decoder.decode_file(file_name, stats=stats,
+                                     demosaic=False)[2]
+    rgb = nef_decoder.decode_file(file_name, WB_MULT)[2]
+
+    calls = []
+    decode_mosaic = nef_decoder.decode_mosaic
+    def counting_decode_mosaic(*args, **kwargs):
+        calls.append(args)
+        return(decode_mosaic(*args, **kwargs))
+    nef_decoder.decode_mosaic = counting_decode_mosaic
+    try:
+        nef = nef_decoder.NEFFile(file_name)
+        assert(nef.tags[271][-1] == nef_decoder.get_tag_value(nef.ifds, 271))
+        assert(numpy.array_equal(nef.raw, mosaic))
+        assert(nef.raw is nef.raw)
+        for key in ('count', 'min', 'max', 'clipped', 'black', 'white'):
+            assert(numpy.array_equal(nef.stats[key], stats[key]))
+
+        output = nef.rgb(WB_MULT)
+        assert(numpy.array_equal(output, rgb))
+        assert(nef.rgb(list(WB_MULT)) is output)
+        other = nef.rgb(WB_MULT, equalize=True)
+        assert(nef.rgb(WB_MULT, equalize=True) is other)
+        assert(numpy.array_equal(nef.rgb(WB_MULT), rgb))
+        assert(len(calls) == 1)
+    finally:
+        nef_decoder.decode_mosaic = decode_mosaic
+
+    (f, data) = (nef.file, nef.data)
+    nef.close()
+    assert(f.closed and nef.file is None and nef.data is None)
+    try:
+        data[0]
+    except ValueError:
+        pass
+    else:
+        raise(AssertionError('The memory map is still open.'))
+
+    with nef_decoder.NEFFile(file_name) as nef:
+        assert(numpy.array_equal(nef.raw, mosaic))
+        (f, data) = (nef.file, nef.data)
+    assert(f.closed)
+    try:
+        data[0]
+    except ValueError:
+        pass
+    else:
+        raise(AssertionError('The memory map is still open.'))
+
+
+def test_export():
+    """
+    A raw archive exported by NEFFile holds the same mosaic and its string tags
+    as text, without their trailing NULs.
+    """
+    dir_name = tempfile.mkdtemp()
+    try:
+        check_export(dir_name)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def check_export(dir_name):
+    (file_name, expected) = write_nef(dir_name, 'export.nef', random_mosaic())
+    archive_name = os.path.join(dir_name, 'export.nefraw')
+    with nef_decoder.NEFFile(file_name) as nef:
+        assert(nef.tags[271][-1] == 'ABC')
+        nef.export(archive_name, WB_MULT, rows_per_chunk=5)
+        with rawarchive.RawArchive(archive_name) as archive:
+            assert(numpy.array_equal(archive.raw, nef.raw))
+            assert(archive.tags[271][-1] == 'ABC')
+            assert(archive.curve_max_len ==
+                   nef.linearization['curve_max_len'])
+            assert(numpy.array_equal(archive.rgb(), nef.rgb(WB_MULT)))
+
+
+if(__name__ == '__main__'):
+    numpy.random.seed(42)
+    for test in (test_decode_files, test_tags, test_roi, test_roi_stats,
+                 test_raw_stats, test_demosaic_bands, test_dtype,
+                 test_nef_file, test_export):
+        test()
+        print('%s: OK' % (test.__name__))
@@ -0,0 +1,183 @@
+"""
+Checks of the pixelutils kernels on synthetic data. Run with
+
+    python test_pixelutils.py
+
+after building pixelutils (see setup.py).
+"""
+import os
+from multiprocessing import cpu_count
+
+import numpy
+
+import pixelutils
+from bench_pixelutils import encode_deltas
+from huffman_tables import huff as NIKON_TREE
+
+
+
+
+WIDTH = 64
+HEIGHT = 48
+SPLIT_ROW = 20
+# Largest deltas the trees used after the split row (1 and 4) store exactly.
+SPLIT_DELTA_MAX = {0: 31, 3: 255}
+
+
+def random_deltas(max_delta, height=HEIGHT, width=WIDTH):
+    """
+    Random (height, width) int32 deltas in [-max_delta, max_delta], with a
+    spread of sizes so that most code lengths of a tree get used.
+    """
+    sizes = numpy.random.randint(0, max_delta.bit_length() + 1,
+                                 size=(height, width))
+    deltas = numpy.random.randint(0, max_delta + 1, size=(height, width))
+    deltas = numpy.minimum(deltas, (1 << sizes) - 1)
+    deltas[numpy.random.random(size=(height, width)) < .5] *= -1
+    return(deltas.astype(numpy.int32))
+
+
+def test_round_trip():
+    """
+    Decoding the Huffman encoded deltas gives them back, for each tree.
+    """
+    for tree_index in (0, 2, 3, 5):
+        max_delta = (1 << (14 if tree_index >= 3 else 12)) - 1
+        deltas = random_deltas(max_delta)
+        decoded = pixelutils.decode_pixel_deltas(WIDTH, HEIGHT, tree_index,
+                                                 encode_deltas(deltas,
+                                                               tree_index),
+                                                 -1, NIKON_TREE)
+        assert(numpy.array_equal(decoded, deltas))
+
+
+def test_split_row():
+    """
+    Rows from the split row on are decoded with the next tree: 0 -> 1 for 12 bit
+    images, 3 -> 4 for 14 bit ones. Rows after the split only use the code
+    lengths that the second tree stores exactly.
+    """
+    for (tree_index, split_max) in sorted(SPLIT_DELTA_MAX.items()):
+        max_delta = (1 << (14 if tree_index >= 3 else 12)) - 1
+        deltas = random_deltas(max_delta)
+        deltas[SPLIT_ROW:] = random_deltas(split_max, HEIGHT - SPLIT_ROW)
+        byte_buffer = encode_deltas(deltas, tree_index, SPLIT_ROW)
+        decoded = pixelutils.decode_pixel_deltas(WIDTH, HEIGHT, tree_index,
+                                                 byte_buffer, SPLIT_ROW,
+                                                 NIKON_TREE)
+        assert(numpy.array_equal(decoded, deltas))
+
+        # Same thing, stopping early, with and without the split.
+        for y1 in (SPLIT_ROW - 2, SPLIT_ROW, HEIGHT - 2):
+            decoded = pixelutils.decode_pixel_deltas(WIDTH, HEIGHT, tree_index,
+                                                     byte_buffer, SPLIT_ROW,
+                                                     NIKON_TREE,
+                                                     (0, 0, WIDTH, y1))
+            assert(numpy.array_equal(decoded, deltas[:y1]))
+
+
+def test_huffman_table_cache():
+    """
+    huffman_table always returns the table of the trees it is given, even when
+    a list of trees is freed and a new one takes its place in memory.
+    """
+    for i in range(100):
+        trees = [NIKON_TREE[i % len(NIKON_TREE)], ]
+        (num_bits, table) = pixelutils.huffman_table(trees, 0)
+        assert(num_bits == trees[0][0])
+        assert(numpy.array_equal(table, numpy.array(trees[0][1])))
+        del(trees)
+
+
+def test_histogram_equalize_checks():
+    """
+    histogram_equalize writes to `out` the same as in place, and refuses an
+    `out` or `hists` that do not fit the image instead of writing past them.
+    """
+    pixels = numpy.random.uniform(0, 65535, size=(3, 40, 40))
+    out = numpy.empty_like(pixels)
+    pixelutils.histogram_equalize(pixels, None, out)
+    assert(numpy.array_equal(out, pixelutils.histogram_equalize(pixels.copy())))
+
+    hists = pixelutils.channel_histograms(pixels)
+    for (bad_hists, bad_out) in ((None, numpy.empty((3, 10, 10))),
+                                 (None, numpy.empty((3, 40, 41))),
+                                 (hists[:2], None),
+                                 (hists[:, :1000], None)):
+        try:
+            pixelutils.histogram_equalize(pixels.copy(), bad_hists, bad_out)
+        except ValueError:
+            continue
+        raise(AssertionError('histogram_equalize accepted bad arguments.'))
+
+
+def equalize_reference(pixels):
+    """
+    Histogram equalization of the (n, h, w) `pixels` with numpy: histograms of
+    the values clipped to [0, 65535] and truncated, cumulative sums scaled to
+    [0, 65535] as lookup tables.
+    """
+    codes = numpy.clip(pixels, 0, 65535).astype(numpy.int64)
+    out = numpy.empty_like(pixels)
+    for c in range(pixels.shape[0]):
+        cdf = numpy.cumsum(numpy.bincount(codes[c].ravel(), minlength=65536),
+                           dtype=numpy.double)
+        lut = (cdf * (65535. / cdf[-1])).astype(pixels.dtype)
+        out[c] = lut[codes[c]]
+    return(out)
+
+
+def test_histogram_equalize():
+    """
+    histogram_equalize gives the same result as numpy, for float32 and float64,
+    with its own histograms or with those balance_channels accumulated.
+    """
+    for dtype in (numpy.float32, numpy.double):
+        # Some values are out of range and get clipped.
+        pixels = numpy.random.uniform(-100, 66000, size=(3, 37, 53))
+        pixels = pixels.astype(dtype)
+        expected = equalize_reference(pixels)
+        assert(numpy.array_equal(pixelutils.histogram_equalize(pixels.copy()),
+                                 expected))
+
+        hists = numpy.zeros(shape=(3, 65536), dtype=numpy.int64)
+        balanced = pixelutils.balance_channels(pixels.copy(), True, False,
+                                               (2., 1., 1.5), hists)
+        expected = equalize_reference(balanced)
+        assert(numpy.array_equal(pixelutils.histogram_equalize(
+            balanced.copy(), hists), expected))
+        assert(numpy.array_equal(pixelutils.balance_channels(
+            pixels.copy(), True, True, (2., 1., 1.5)), expected))
+
+
+def test_get_num_bands():
+    """
+    get_num_bands uses the first OMP_NUM_THREADS value and ignores the ones it
+    cannot use.
+    """
+    saved = os.environ.get('OMP_NUM_THREADS')
+    try:
+        for (value, expected) in (('3', 3), ('8,4', 8), (' 2 ', 2), ('', None),
+                                  ('abc', None), ('0', None), ('-2', None)):
+            os.environ['OMP_NUM_THREADS'] = value
+            if(expected is None):
+                expected = min(cpu_count(), 1000)
+            assert(pixelutils.get_num_bands(None, 1000) == expected)
+            assert(pixelutils.get_num_bands(5, 1000) == 5)
+            assert(pixelutils.get_num_bands(None, 1) == 1)
+    finally:
+        if(saved is None):
+            del(os.environ['OMP_NUM_THREADS'])
+        else:
+            os.environ['OMP_NUM_THREADS'] = saved
+
+
+
+
+if(__name__ == '__main__'):
+    numpy.random.seed(42)
+    for test in (test_round_trip, test_split_row, test_huffman_table_cache,
+                 test_histogram_equalize, test_histogram_equalize_checks,
+                 test_get_num_bands):
+        test()
+        print('%s: OK' % (test.__name__))
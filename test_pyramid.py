@@ -0,0 +1,131 @@
+"""
+Checks of the Deep Zoom pyramids written by pyramid on a synthetic raster. Run
+with
+
+    python test_pyramid.py
+
+(needs PIL).
+"""
+import math
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
+from PIL import Image
+
+import pyramid
+
+
+
+
+# An odd sized image and tiles that do not divide it.
+WIDTH = 77
+HEIGHT = 45
+TILE_SIZE = 16
+
+
+def expected_levels(pixels):
+    """
+    The levels of the pyramid of the (3, h, w) `pixels` as (h, w, 3) uint8
+    arrays, from the full resolution one down to 1x1, computed on the whole
+    image at once.
+    """
+    level = numpy.asarray(pixels, dtype=numpy.float32).transpose(1, 2, 0)
+    levels = []
+    while(True):
+        levels.append(numpy.clip(level / 257., 0., 255.).round()
+                      .astype(numpy.uint8))
+        if(level.shape[:2] == (1, 1)):
+            return(levels)
+        level = pyramid.reduce_band(level)
+
+
+def test_write_pyramid():
+    """
+    Each level has the expected tiles, which hold the same pixels as the
+    reduction of the whole image, and the .dzi descriptor gives the size and
+    tile size.
+    """
+    dir_name = tempfile.mkdtemp()
+    try:
+        check_write_pyramid(dir_name)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def check_write_pyramid(dir_name):
+    pixels = numpy.random.uniform(0, 65535, size=(3, HEIGHT, WIDTH))
+    file_name = pyramid.write_pyramid(pixels, os.path.join(dir_name, 'img'),
+                                      tile_size=TILE_SIZE, threads=3)
+    assert(file_name == os.path.join(dir_name, 'img.dzi'))
+
+    levels = expected_levels(pixels)
+    num_levels = int(math.ceil(math.log(max(WIDTH, HEIGHT), 2))) + 1
+    assert(len(levels) == num_levels)
+    assert(sorted(os.listdir(os.path.join(dir_name, 'img_files'))) ==
+           sorted(str(n) for n in range(num_levels)))
+    for (i, level) in enumerate(levels):
+        (height, width) = level.shape[:2]
+        level_dir = os.path.join(dir_name, 'img_files',
+                                 str(num_levels - 1 - i))
+        cols = (width + TILE_SIZE - 1) // TILE_SIZE
+        rows = (height + TILE_SIZE - 1) // TILE_SIZE
+        assert(len(os.listdir(level_dir)) == cols * rows)
+        for row in range(rows):
+            for col in range(cols):
+                tile = numpy.asarray(Image.open(os.path.join(
+                    level_dir, '%d_%d.png' % (col, row))))
+                assert(numpy.array_equal(
+                    tile, level[row * TILE_SIZE:(row + 1) * TILE_SIZE,
+                                col * TILE_SIZE:(col + 1) * TILE_SIZE]))
+
+    f = open(file_name)
+    dzi = f.read()
+    f.close()
+    assert('Format="png"' in dzi and 'TileSize="%d"' % (TILE_SIZE) in dzi)
+    assert('<Size Width="%d" Height="%d"/>' % (WIDTH, HEIGHT) in dzi)
+
+
+def test_write_failure():
+    """
+    When a tile cannot be written, the error is raised, the writing threads
+    are stopped and no descriptor is written.
+    """
+    dir_name = tempfile.mkdtemp()
+    try:
+        check_write_failure(dir_name)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def check_write_failure(dir_name):
+    def failing_write_tile(tile, file_name, fmt):
+        raise(IOError('Disk full.'))
+
+    pixels = numpy.random.uniform(0, 65535, size=(3, HEIGHT, WIDTH))
+    file_name = os.path.join(dir_name, 'img.dzi')
+    num_threads = threading.active_count()
+    write_tile = pyramid.write_tile
+    pyramid.write_tile = failing_write_tile
+    try:
+        pyramid.write_pyramid(pixels, file_name, tile_size=TILE_SIZE,
+                              threads=3)
+    except IOError:
+        pass
+    else:
+        raise(AssertionError('The write error was not raised.'))
+    finally:
+        pyramid.write_tile = write_tile
+    assert(threading.active_count() == num_threads)
+    assert(not os.path.exists(file_name))
+
+
+
+
+if(__name__ == '__main__'):
+    numpy.random.seed(42)
+    for test in (test_write_pyramid, test_write_failure):
+        test()
+        print('%s: OK' % (test.__name__))
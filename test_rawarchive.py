@@ -0,0 +1,140 @@
+"""
+Round trip checks of rawarchive on synthetic mosaics. Run with
+
+    python test_rawarchive.py
+
+after building pixelutils (see setup.py).
+"""
+import os
+import shutil
+import tempfile
+
+import numpy
+
+import pixelutils
+import rawarchive
+
+
+
+
+HEIGHT = 45
+# Odd and even widths, chunks of one row, of an odd number of rows and larger
+# than the whole mosaic.
+WIDTHS = (37, 52)
+ROWS_PER_CHUNK = (1, 7, 64)
+# (y0, y1): within a chunk, across chunk boundaries, empty, partly or wholly
+# outside of the mosaic.
+ROW_RANGES = ((0, None), (5, 12), (6, 7), (13, 31), (44, 45), (10, 10),
+              (-3, 2), (40, 100), (50, 60))
+WB_MULT = (2., 1., 1.5)
+
+
+def random_mosaic(height, width):
+    """
+    A random (height, width) uint16 mosaic whose same color neighbours are
+    often at opposite ends of the range, so that their differences wrap.
+    """
+    mosaic = numpy.random.randint(0, 1 << 16, size=(height, width))
+    extremes = numpy.random.random(size=(height, width)) < .5
+    mosaic[extremes] = numpy.where(numpy.arange(width) % 4 < 2, 0,
+                                   (1 << 16) - 1)[numpy.nonzero(extremes)[1]]
+    return(mosaic.astype(numpy.uint16))
+
+
+def test_round_trip():
+    """
+    read_rows gives back any range of rows of the mosaic, whatever the width
+    and the chunk size.
+    """
+    dir_name = tempfile.mkdtemp()
+    try:
+        check_round_trip(dir_name)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def check_round_trip(dir_name):
+    file_name = os.path.join(dir_name, 'mosaic.nefraw')
+    for width in WIDTHS:
+        mosaic = random_mosaic(HEIGHT, width)
+        for rows_per_chunk in ROWS_PER_CHUNK:
+            rawarchive.write_archive(file_name, mosaic, (2, 1, 1, 0),
+                                     rows_per_chunk=rows_per_chunk)
+            with rawarchive.RawArchive(file_name) as archive:
+                assert((archive.height, archive.width) == mosaic.shape)
+                assert(numpy.array_equal(archive.raw, mosaic))
+                for (y0, y1) in ROW_RANGES:
+                    rows = archive.read_rows(y0, y1)
+                    assert(rows.dtype == numpy.uint16)
+                    assert(numpy.array_equal(rows, mosaic[max(0, y0):y1]))
+
+
+def test_header():
+    """
+    The header fields and the tags are read back as written; tags that cannot
+    be stored as JSON are skipped.
+    """
+    dir_name = tempfile.mkdtemp()
+    try:
+        check_header(dir_name)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def check_header(dir_name):
+    file_name = os.path.join(dir_name, 'header.nefraw')
+    mosaic = random_mosaic(HEIGHT, WIDTHS[0])
+    curve = numpy.arange(4096) * 2
+    tags = [[None, 271, 'Make', 'ABC'],
+            [None, 33434, 'Exposure Time', ['1 / 250']],
+            ['makernote', 2, 'ISO', [0, 200]],
+            [None, 272, 'Model', object()]]
+    rawarchive.write_archive(file_name, mosaic, (1, 0, 2, 1), curve, 3001,
+                             WB_MULT, tags)
+    with rawarchive.RawArchive(file_name) as archive:
+        assert(archive.cfa_pattern == (1, 0, 2, 1))
+        assert(archive.curve == curve.tolist())
+        assert(archive.curve_max_len == 3001)
+        assert(archive.wb == WB_MULT)
+        assert(sorted(archive.tags, key=str) ==
+               sorted([271, 33434, ('makernote', 2)], key=str))
+        assert(archive.tags[271][-1] == 'ABC')
+        assert(archive.tags[33434][-1] == ['1 / 250'])
+        assert(archive.tags[('makernote', 2)][-1] == [0, 200])
+
+
+def test_rgb():
+    """
+    rgb demosaics the stored mosaic exactly like pixelutils.demosaic does the
+    original, with the archived white balance by default.
+    """
+    dir_name = tempfile.mkdtemp()
+    try:
+        check_rgb(dir_name)
+    finally:
+        shutil.rmtree(dir_name)
+
+
+def check_rgb(dir_name):
+    file_name = os.path.join(dir_name, 'rgb.nefraw')
+    mosaic = random_mosaic(HEIGHT - 1, WIDTHS[1])
+    for cfa_pattern in sorted(pixelutils.CFA_PHASES):
+        rawarchive.write_archive(file_name, mosaic, cfa_pattern, wb=WB_MULT,
+                                 rows_per_chunk=ROWS_PER_CHUNK[1])
+        with rawarchive.RawArchive(file_name) as archive:
+            for dtype in (numpy.float32, numpy.double):
+                expected = pixelutils.demosaic(mosaic, cfa_pattern, True,
+                                               False, WB_MULT, dtype=dtype)
+                assert(numpy.array_equal(archive.rgb(dtype=dtype), expected))
+            expected = pixelutils.demosaic(mosaic, cfa_pattern, True, True)
+            assert(numpy.array_equal(archive.rgb((1., 1., 1.), True, True),
+                                     expected))
+
+
+
+
+if(__name__ == '__main__'):
+    numpy.random.seed(42)
+    for test in (test_round_trip, test_header, test_rgb):
+        test()
+        print('%s: OK' % (test.__name__))